@@ -15,9 +15,25 @@ import re
 import string
 import uuid
 import gzip
+import codecs
+import hashlib
+import json
+import bisect
+import argparse
+import tarfile
+import fnmatch
+import mimetypes
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape as xml_escape
 from email import utils as email_utils
 from configparser import ConfigParser
+import concurrent.futures
+import multiprocessing
 import markdown
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 class WeavyError(Exception):
     pass
@@ -36,12 +52,36 @@ def read_file(filename):
     f.close()
     return content_unicode
 
+def read_chunks(filename, chunk_size=65536):
+    f = open(filename, "rb")
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        yield chunk
+    f.close()
+
 class SiteCategories:
     BLOG = "blog"
     PAGES = "page"
     MEDIA = "media"
     FEEDS = "feed"
-    categories = [BLOG, PAGES, MEDIA, FEEDS]
+    SRCSET = "srcset"
+    SITEMAPS = "sitemap"
+    categories = [BLOG, PAGES, MEDIA, FEEDS, SRCSET, SITEMAPS]
+
+_reference_re = re.compile(r'\$\{((?:%s):[^}]+)\}' % '|'.join(SiteCategories.categories))
+
+def find_references(data):
+    """
+    @return list of (item name string, line number) tuples
+        for every ${category:name} reference in data
+    """
+    references = []
+    lineno = 1
+    pos = 0
+    for m in _reference_re.finditer(data):
+        lineno += data.count("\n", pos, m.start())
+        pos = m.start()
+        references.append( (m.group(1), lineno) )
+    return references
 
 class MicroTemplateEngine:
     def __init__(self, template_dir, item_name_resolver):
@@ -49,6 +89,8 @@ class MicroTemplateEngine:
         self.inr = item_name_resolver
         self.tpl = {}
         self.tpl_urls = {} # placeholder->itemname string
+        self.tpl_digest = hashlib.sha1()
+        self.tpl_references = {} # template filename->[(itemname string, line number)]
 
     def load_all_templates(self):
         self.__load_tpl('site', 'html')
@@ -61,8 +103,24 @@ class MicroTemplateEngine:
         self.__load_tpl('nav_node', 'html')
         self.__load_tpl('blog_rss', 'xml')
         self.__load_tpl('post_rss', 'xml')
+        self.__load_tpl('feed_link', 'xml')
+        self.__load_tpl('feed_archive_marker', 'xml')
+        self.__load_tpl('sitemap', 'xml')
+        self.__load_tpl('sitemap_url', 'xml')
+        self.__load_tpl('sitemap_index', 'xml')
+        self.__load_tpl('sitemap_ref', 'xml')
         self.__load_tpl('blog_top_navigation', 'html')
         self.__load_tpl('blog_bottom_navigation', 'html')
+        self.__load_tpl('archive', 'html')
+        self.__load_tpl('archive_entry', 'html')
+        self.__load_tpl('post_navigation', 'html')
+        self.__load_tpl('link', 'html')
+
+    def get_templates_digest(self):
+        return self.tpl_digest.hexdigest()
+
+    def get_template_references(self):
+        return self.tpl_references
     
     def __make_unique_placeholder(self, data):
         temp = data[0]
@@ -73,6 +131,8 @@ class MicroTemplateEngine:
     def __load_tpl(self, template_name, file_ending):
         filename = os.path.join(self.template_dir, '_%s.%s' % (template_name, file_ending))
         tpl_data = read_file(filename)
+        self.tpl_digest.update( ('%s\0%s\0' % (template_name, tpl_data)).encode("utf8") )
+        self.tpl_references[filename] = find_references(tpl_data)
         
         url_placeholders = []
         for cat in SiteCategories.categories:
@@ -91,11 +151,33 @@ class MicroTemplateEngine:
         #add new placeholders to data
         data = dict(data)
         for new_placeholder,item_name_str in self.tpl_urls.items():
-            data[new_placeholder] = self.inr.get_rel_path_http(ItemName.from_str(item_name_str), from_item_name) 
+            data[new_placeholder] = self.__resolve_reference(item_name_str, from_item_name)
 
         temp = tpl.safe_substitute(data)
         return temp
     
+    def __render_segments(self, template, data, from_item_name):
+        """
+        render a template around its ${content} slot, so the content
+        can be streamed in between instead of being substituted as one string
+
+        @return tuple (head, tail) of the text before and after the content
+        """
+        marker = self.__make_unique_placeholder(self.tpl[template].template)
+        data = dict(data)
+        data['content'] = marker
+        rendered = self.__render(template, data, from_item_name)
+        segments = rendered.split(marker)
+        if len(segments) != 2:
+            raise WeavyError('template %s must contain exactly one ${content} placeholder' % template)
+        return (segments[0], segments[1])
+
+    def __resolve_reference(self, item_name_str, from_item_name):
+        item_name = ItemName.from_str(item_name_str)
+        if item_name.category == SiteCategories.SRCSET:
+            return self.inr.get_srcset_http(item_name, from_item_name)
+        return self.inr.get_rel_path_http(item_name, from_item_name)
+
     def render_content(self, from_item_name, content):
         url_placeholders = []
         for cat in SiteCategories.categories:
@@ -110,7 +192,7 @@ class MicroTemplateEngine:
         
         data = {}
         for placeholder, item_name_str in urlmap.items():
-            data[placeholder] = self.inr.get_rel_path_http(ItemName.from_str(item_name_str), from_item_name)
+            data[placeholder] = self.__resolve_reference(item_name_str, from_item_name)
 
         template = string.Template(content)
         rendered_content = template.safe_substitute(data)
@@ -140,26 +222,47 @@ class MicroTemplateEngine:
         }, from_item_name)
 
 
-    def render_blog(self, from_item_name, content, top_navigation, bottom_navigation):
-        return self.__render('blog', {
+    def render_blog_segments(self, from_item_name, top_navigation, bottom_navigation, archive_url):
+        return self.__render_segments('blog', {
             'top_navigation':top_navigation,
-            'content':content,
-            'bottom_navigation':bottom_navigation
+            'bottom_navigation':bottom_navigation,
+            'archive_url':archive_url
         }, from_item_name)
 
 
-    def render_blog_rss(self, from_item_name, content, site_baseurl, site_title, site_description):
-        return self.__render('blog_rss', { \
-            'content':content, \
+    def render_blog_rss_segments(self, from_item_name, site_baseurl, site_title, site_description, feed_links=""):
+        return self.__render_segments('blog_rss', { \
             'baseurl':site_baseurl, \
             'sitetitle':site_title, \
-            'sitedescription':site_description \
+            'sitedescription':site_description, \
+            'feedlinks':feed_links \
         }, from_item_name)
 
+    def render_feed_link(self, from_item_name, rel, href):
+        return self.__render('feed_link', {'rel':rel, 'href':href}, from_item_name)
+
+    def render_feed_archive_marker(self, from_item_name):
+        return self.__render('feed_archive_marker', {}, from_item_name)
+
+    def render_sitemap(self, from_item_name, content):
+        return self.__render('sitemap', {'content':content}, from_item_name)
+
+    def render_sitemap_url(self, from_item_name, loc, lastmod):
+        return self.__render('sitemap_url', {'loc':loc, 'lastmod':lastmod}, from_item_name)
+
+    def render_sitemap_index(self, from_item_name, content):
+        return self.__render('sitemap_index', {'content':content}, from_item_name)
+
+    def render_sitemap_ref(self, from_item_name, loc, lastmod):
+        return self.__render('sitemap_ref', {'loc':loc, 'lastmod':lastmod}, from_item_name)
+
 
     def render_site(self, from_item_name, navigation, content):
         return self.__render('site', {'navigation':navigation, 'content':content}, from_item_name)
 
+    def render_site_segments(self, from_item_name, navigation):
+        return self.__render_segments('site', {'navigation':navigation}, from_item_name)
+
     def render_page(self, from_item_name, content):
         return self.__render('page', {'content':content}, from_item_name)
 
@@ -181,6 +284,29 @@ class MicroTemplateEngine:
             "next_page_url":next_page_url
             }, from_item_name)
 
+    def render_archive(self, from_item_name, title, archive_navigation, content):
+        return self.__render('archive', {
+            'title':title,
+            'archive_navigation':archive_navigation,
+            'content':content
+            }, from_item_name)
+
+    def render_archive_entry(self, from_item_name, title, postdate, posturl):
+        return self.__render('archive_entry', {
+            'title':title,
+            'postdate':postdate,
+            'posturl':posturl
+            }, from_item_name)
+
+    def render_post_navigation(self, from_item_name, newer_post, older_post):
+        return self.__render('post_navigation', {
+            'newer_post':newer_post,
+            'older_post':older_post
+            }, from_item_name)
+
+    def render_link(self, from_item_name, linkurl, linktext):
+        return self.__render('link', {'linkurl':linkurl, 'linktext':linktext}, from_item_name)
+
 class FolderLocator:
     def __init__(self):
         self.in_dir = os.path.abspath('.')
@@ -189,6 +315,7 @@ class FolderLocator:
         self.template_dir = '%s/template/' % self.in_dir
         self.out_dir = '%s/out/' % self.in_dir
         self.media_dir = '%s/media/' % self.in_dir
+        self.cache_dir = '%s/.weavy_cache/' % self.in_dir
 
         def _check_dir(dirpath, dirname):
             if not os.path.isdir(dirpath):
@@ -218,6 +345,9 @@ class FolderLocator:
     def get_media_dir(self):
         return self.media_dir
 
+    def get_cache_dir(self):
+        return self.cache_dir
+
 
 class DirectoryLister:
     def __init__(self, directory):
@@ -299,14 +429,38 @@ def parse_metadata(site_elem_data):
 
     return (metadata, os.linesep.join( lines[content_begin_lineno:] ))
 
-def load_site_data(dirtoload, out_map, site_item_facmethod):
+def load_site_data(dirtoload, out_map, site_item_facmethod, io_executor=None):
+    """
+    @param io_executor if given, site items are made in this executor,
+        so reading the files of a directory overlaps; items are still
+        added to out_map in directory listing order
+    """
     dirlst = DirectoryLister(dirtoload)
     dirlst.collect()
     files = dirlst.get_files()
-    for filename in files:
-        item = site_item_facmethod(filename)
+    if io_executor is None:
+        items = map(site_item_facmethod, files)
+    else:
+        items = io_executor.map(site_item_facmethod, files)
+    for item in items:
         out_map[str(item.name)] = item
 
+class ItemSelector:
+    """
+    selects items by glob patterns on their names,
+    e.g. blog:2015/02/*, page:projects/*, media:*.css
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def matches(self, item_name):
+        item_name_str = str(item_name)
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(item_name_str, pattern):
+                return True
+        return False
+
+
 class ItemName:
     def __init__(self):
         self.category = ""
@@ -336,9 +490,11 @@ class SiteItem:
         self.title = "" #a title from the metadata
         self.created = None #datetime.datetime object
         self.last_updated = None #datetime.datetime object
-        self.content = "" #the raw content
+        self.last_changed = None #datetime.datetime object from the metadata
+        self.content = "" #the raw content, None if it was not loaded
         self.author = "" #the author
         self.tags = [] #a list of strings that are tags
+        self.references = [] #(item name string, line number) of ${...} references in the source file
 
     def __str__(self):
         return '{name:%s, title:%s, created:%s, last_updated:%s}' % \
@@ -368,18 +524,196 @@ class SiteItem:
             
             
 _mdproc = markdown.Markdown(safe_mode=False, extensions=['codehilite'], output_format='xhtml1')
-def filter_content(content, filename):
-    if filename.endswith(".markdown"):
-        content = _mdproc.convert(content)
-    return content
+_mdproc_id = 'markdown %s codehilite xhtml1' % getattr(markdown, '__version__', getattr(markdown, 'version', ''))
+def _convert_markdown(content):
+    return _mdproc.convert(content)
+
+def _markdown_key(content):
+    return hashlib.sha1( ('%s\0%s' % (_mdproc_id, content)).encode("utf8") ).hexdigest()
+
+def filter_content(content, filename, artifact_store=None):
+    if not filename.endswith(".markdown"):
+        return content
+    if artifact_store is None:
+        return _convert_markdown(content)
+
+    key = _markdown_key(content)
+    converted = artifact_store.get(key)
+    if converted is not None:
+        return converted.decode("utf8")
+    converted = _convert_markdown(content)
+    artifact_store.put(key, converted.encode("utf8"))
+    return converted
+
+MARKDOWN_POOL_MIN_DOCUMENTS = 32
+def make_process_executor():
+    """
+    @return a process pool executor (for markdown conversion and image
+        derivatives) or None if this platform cannot fork.
+        the workers are forked, not spawned: spawned workers import the
+        __main__ module of the caller again, which breaks scripts that call
+        main() without an if __name__ == "__main__" guard. forking is only
+        safe while no other threads run, so the pool must be used after
+        the thread pools that read the sources are shut down.
+    """
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return concurrent.futures.ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork"))
+
+def filter_contents(items, artifact_store=None, markdown_executor=None):
+    """
+    replace the raw content of items with their filtered content,
+    like filter_content() for each item but with all markdown that
+    is not in the artifact store converted in one batch
+
+    @param markdown_executor if given, markdown is converted in this (process pool) executor,
+        unless there are less than MARKDOWN_POOL_MIN_DOCUMENTS documents to convert
+        (then starting the workers takes longer than converting them here)
+    """
+    pending = [] #(item, artifact key) of markdown still to convert
+    for item in items:
+        if not item.path.endswith(".markdown"):
+            continue
+        key = None
+        if artifact_store is not None:
+            key = _markdown_key(item.content)
+            converted = artifact_store.get(key)
+            if converted is not None:
+                item.content = converted.decode("utf8")
+                continue
+        pending.append( (item, key) )
+
+    contents = [ item.content for item, _ in pending ]
+    if markdown_executor is None or len(contents) < MARKDOWN_POOL_MIN_DOCUMENTS:
+        converted_contents = map(_convert_markdown, contents)
+    else:
+        converted_contents = markdown_executor.map(_convert_markdown, contents, chunksize=8)
+    for (item, key), converted in zip(pending, converted_contents):
+        item.content = converted
+        if key is not None:
+            artifact_store.put(key, converted.encode("utf8"))
+
+def load_item_content(item, artifact_store=None):
+    """
+    (re)load the content of an item that was loaded without it
+    """
+    _, content = parse_metadata(read_file(item.path))
+    item.content = filter_content(content, item.path, artifact_store)
+
+class PostIndex:
+    """
+    keeps posts sorted by their creation date (ties are broken by name),
+    so date ranges can be looked up with bisect instead of scanning
+    and re-sorting all posts
+    """
+    def __init__(self):
+        self.keys = [] #(created, name) in ascending order
+        self.posts = [] #posts in the same order as keys
+
+    def __len__(self):
+        return len(self.posts)
+
+    def add(self, post):
+        key = self.__key(post)
+        i = bisect.bisect_left(self.keys, key)
+        self.keys.insert(i, key)
+        self.posts.insert(i, post)
+
+    def remove(self, post):
+        i = self.__find(post)
+        del self.keys[i]
+        del self.posts[i]
+
+    def get_posts(self):
+        """
+        @return all posts, newest first
+        """
+        return self.posts[::-1]
+
+    def get_posts_between(self, start, end):
+        """
+        @return posts created in [start, end), newest first
+        """
+        lo = bisect.bisect_left(self.keys, (start,))
+        hi = bisect.bisect_left(self.keys, (end,))
+        return self.posts[lo:hi][::-1]
+
+    def get_neighbours(self, post):
+        """
+        @return tuple (newer_post, older_post), either may be None
+        """
+        i = self.__find(post)
+        older = self.posts[i-1] if i > 0 else None
+        newer = self.posts[i+1] if i+1 < len(self.posts) else None
+        return (newer, older)
+
+    def get_months(self):
+        """
+        @return sorted list of (year, month) tuples that have posts
+        """
+        months = []
+        for created,_ in self.keys:
+            month = (created.year, created.month)
+            if len(months) == 0 or months[-1] != month:
+                months.append(month)
+        return months
+
+    def __find(self, post):
+        key = self.__key(post)
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            raise WeavyError('post %s is not in the post index' % post.name)
+        return i
+
+    def __key(self, post):
+        return (post.created, str(post.name))
+
 
 class BlogDataSource:
     def __init__(self, blog_dir):
         self.blog_dir = blog_dir
         self.posts = {} #map name->post
+        self.index = PostIndex()
+        self.artifact_store = None
+        self.unfiltered = [] #posts whose content is not filtered yet, see read_data()
+
+    def set_artifact_store(self, artifact_store):
+        self.artifact_store = artifact_store
+
+    def load_data(self, selector=None):
+        """
+        @param selector if given, only the content of matching posts is converted,
+            all other posts are loaded with their metadata only
+        """
+        self.read_data(selector)
+        filter_contents(self.take_unfiltered(), self.artifact_store)
 
-    def load_data(self):
-        load_site_data(self.blog_dir, self.posts, self.__make_post)
+    def read_data(self, selector=None, io_executor=None):
+        """
+        like load_data(), but the content of the posts is left unfiltered,
+        it has to be filtered with filter_contents(take_unfiltered())
+
+        @param io_executor executor the post files are read in, see load_site_data()
+        """
+        previous_posts = dict(self.posts)
+        load_site_data(self.blog_dir, self.posts, lambda filename: self.__make_post(filename, selector), io_executor)
+        for name, post in self.posts.items():
+            previous_post = previous_posts.get(name)
+            if previous_post is post:
+                continue
+            if previous_post is not None:
+                self.index.remove(previous_post)
+            self.index.add(post)
+            if post.content is not None:
+                self.unfiltered.append(post)
+
+    def take_unfiltered(self):
+        """
+        @return the posts read with unfiltered content, the list is emptied
+        """
+        unfiltered = self.unfiltered
+        self.unfiltered = []
+        return unfiltered
 
     def get_post(self, name):
         ''' @param name the name of a blog post
@@ -389,19 +723,33 @@ class BlogDataSource:
         return self.posts[name]
 
     def get_posts(self):
-        post_list = [ v for _,v in self.posts.items() ]
-        post_list.sort(key = lambda x: x.created, reverse=True)
-        return post_list
+        return self.index.get_posts()
+
+    def get_posts_between(self, start, end):
+        return self.index.get_posts_between(start, end)
 
-    def __make_post(self, filename):
+    def get_neighbours(self, post):
+        return self.index.get_neighbours(post)
+
+    def load_content(self, post):
+        load_item_content(post, self.artifact_store)
+
+    def get_months(self):
+        return self.index.get_months()
+
+    def __make_post(self, filename, selector=None):
         post = SiteItem()
         post.set_name_from_filename(SiteCategories.BLOG, filename)
         post.path = os.path.join(self.blog_dir, filename)
         abs_filename = os.path.join(self.blog_dir, filename)
         post.created = self.__datetime_from_filename(abs_filename)
         post_data = read_file(abs_filename)
+        post.references = find_references(post_data)
         metadata, content = parse_metadata(post_data)
-        post.content = filter_content(content, filename)
+        if selector is None or selector.matches(post.name):
+            post.content = content #filtered later, see read_data()
+        else:
+            post.content = None
         post.set_metadata(metadata)
         return post
 
@@ -418,9 +766,40 @@ class PagesDataSource:
     def __init__(self, pages_dir):
         self.pages_dir = pages_dir
         self.pages = {}
+        self.artifact_store = None
+        self.unfiltered = [] #pages whose content is not filtered yet, see read_data()
 
-    def load_data(self):
-        load_site_data(self.pages_dir, self.pages, self.__make_page)
+    def set_artifact_store(self, artifact_store):
+        self.artifact_store = artifact_store
+
+    def load_data(self, selector=None):
+        """
+        @param selector if given, only the content of matching pages is converted,
+            all other pages are loaded with their metadata only
+        """
+        self.read_data(selector)
+        filter_contents(self.take_unfiltered(), self.artifact_store)
+
+    def read_data(self, selector=None, io_executor=None):
+        """
+        like load_data(), but the content of the pages is left unfiltered,
+        it has to be filtered with filter_contents(take_unfiltered())
+
+        @param io_executor executor the page files are read in, see load_site_data()
+        """
+        previous_pages = dict(self.pages)
+        load_site_data(self.pages_dir, self.pages, lambda filename: self.__make_page(filename, selector), io_executor)
+        for name, page in self.pages.items():
+            if page is not previous_pages.get(name) and page.content is not None:
+                self.unfiltered.append(page)
+
+    def take_unfiltered(self):
+        """
+        @return the pages read with unfiltered content, the list is emptied
+        """
+        unfiltered = self.unfiltered
+        self.unfiltered = []
+        return unfiltered
 
     def get_page(self, page_name):
         return self.pages[page_name]
@@ -428,13 +807,20 @@ class PagesDataSource:
     def get_pages(self):
         return [ v for _,v in self.pages.items() ]
 
-    def __make_page(self, filename):
+    def load_content(self, page):
+        load_item_content(page, self.artifact_store)
+
+    def __make_page(self, filename, selector=None):
         page = SiteItem()
         page.set_name_from_filename(SiteCategories.PAGES, filename)
         page.path = os.path.join( self.pages_dir, filename )
         page_data = read_file( os.path.join( self.pages_dir, filename) )
+        page.references = find_references(page_data)
         metadata, content = parse_metadata(page_data)
-        page.content = filter_content(content, filename)
+        if selector is None or selector.matches(page.name):
+            page.content = content #filtered later, see read_data()
+        else:
+            page.content = None
         page.set_metadata(metadata)
         return page
 
@@ -443,8 +829,8 @@ class MediaDataSource:
         self.media_dir = media_dir
         self.media = {}
 
-    def load_data(self):
-        load_site_data(self.media_dir, self.media, self.__make_media)
+    def load_data(self, io_executor=None):
+        load_site_data(self.media_dir, self.media, self.__make_media, io_executor)
 
     def get_media(self, media_name):
         return self.media[media_name]
@@ -452,6 +838,9 @@ class MediaDataSource:
     def get_medias(self):
         return [ v for _,v in self.media.items() ]
 
+    def add_media(self, media_item):
+        self.media[str(media_item.name)] = media_item
+
     def __make_media(self, filename):
         media = SiteItem()
         media.set_name_from_filename(SiteCategories.MEDIA, filename)
@@ -460,16 +849,262 @@ class MediaDataSource:
 
 
 
+class LinkValidator:
+    """
+    checks ${category:name} references against a hashed index
+    of all item names that exist in the site
+    """
+    def __init__(self):
+        self.known_names = set()
+        self.dangling = [] #(filename, line number, item name string)
+
+    def add_item_names(self, item_names):
+        for item_name in item_names:
+            self.known_names.add(str(item_name))
+
+    def check(self, filename, references):
+        for item_name_str, lineno in references:
+            if not self.__exists(ItemName.from_str(item_name_str)):
+                self.dangling.append( (filename, lineno, item_name_str) )
+
+    def get_dangling(self):
+        return self.dangling
+
+    def __exists(self, item_name):
+        if item_name.category == SiteCategories.SRCSET:
+            item_name = ItemName.from_parts(SiteCategories.MEDIA, item_name.name)
+        return str(item_name) in self.known_names
+
+
 class DataSources:
     def __init__(self, blog_data_source, pages_data_source, media_data_source):
         self.blog = blog_data_source
         self.pages = pages_data_source
         self.media = media_data_source
 
+class FileDigestCache:
+    """
+    sha1 digests of files, remembered in a cache file together
+    with the size and mtime of each file, so unchanged files
+    are hashed only once and not again on every build
+    """
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+        self.cache = {} #abs path -> [size, mtime, digest]
+        self.used = {} #entries looked up during this build
+
+    def load(self):
+        if not os.path.isfile(self.cache_filename):
+            return
+        try:
+            self.cache = json.loads(read_file(self.cache_filename))
+        except ValueError:
+            log('ignoring broken digest cache %s' % self.cache_filename)
+            self.cache = {}
+
+    def save(self):
+        if len(self.used) == 0:
+            return
+        mkpath_for_file(self.cache_filename)
+        f = open(self.cache_filename, "wb")
+        f.write(json.dumps(self.used, sort_keys=True).encode("utf8"))
+        f.close()
+
+    def get_digest(self, path):
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            digest = cached[2]
+        else:
+            digest = self.__hash_file(path)
+        self.cache[path] = self.used[path] = [stat.st_size, stat.st_mtime, digest]
+        return digest
+
+    def set_mtime(self, path, mtime):
+        """
+        set the mtime of a file, its cached digest stays valid
+        """
+        digest = self.get_digest(path)
+        os.utime(path, (mtime, mtime))
+        stat = os.stat(path)
+        self.cache[path] = self.used[path] = [stat.st_size, stat.st_mtime, digest]
+
+    def __hash_file(self, path):
+        h = hashlib.sha1()
+        f = open(path, "rb")
+        for block in iter(lambda: f.read(65536), b""):
+            h.update(block)
+        f.close()
+        return h.hexdigest()
+
+
+class MediaFingerprinter:
+    """
+    maps media names to content-hashed names,
+    e.g. site.css -> site.3f9a1c2b.css
+    """
+    DIGEST_LENGTH = 8
+
+    def __init__(self, file_digest_cache, output_filters=[]):
+        """
+        @param output_filters the filters of the build, media files they apply to
+            are hashed after filtering, so the name changes whenever the published
+            bytes do (also when only the filter code changed)
+        """
+        self.digests = file_digest_cache
+        self.filtered_target = FilteredOutputTarget(output_filters, None)
+        self.fingerprinted_names = {} #media name -> fingerprinted media name
+
+    def fingerprint(self, media_items):
+        for media_item in media_items:
+            if self.filtered_target.is_filtered(media_item.path):
+                digest = self.__get_filtered_digest(media_item.path)
+            else:
+                digest = self.digests.get_digest(media_item.path)
+            digest = digest[:self.DIGEST_LENGTH]
+            media_name = media_item.name.name
+            self.fingerprinted_names[media_name] = self.__make_name(media_name, digest)
+
+    def get_fingerprinted_name(self, media_name):
+        return self.fingerprinted_names.get(media_name, media_name)
+
+    def __get_filtered_digest(self, path):
+        f = open(path, "rb")
+        content = f.read()
+        f.close()
+        sha1 = hashlib.sha1()
+        for chunk in self.filtered_target.filter_stream(path, [content]):
+            sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def __make_name(self, media_name, digest):
+        base, ext = os.path.splitext(media_name)
+        return '%s.%s%s' % (base, digest, ext)
+
+
+def _make_image_derivative(job):
+    src, dst, width, quality = job
+    image = Image.open(src)
+    height = max(1, int(round(image.size[1] * width / float(image.size[0]))))
+    derivative = image.resize((width, height), Image.LANCZOS)
+    _, ext = os.path.splitext(dst)
+    tmp_dst = '%s.tmp%d%s' % (dst, os.getpid(), ext)
+    if ext.lower() in (".jpg", ".jpeg"):
+        if derivative.mode not in ("RGB", "L"):
+            derivative = derivative.convert("RGB")
+        derivative.save(tmp_dst, quality=quality, optimize=True, progressive=True)
+    elif ext.lower() == ".webp":
+        derivative.save(tmp_dst, quality=quality)
+    else:
+        derivative.save(tmp_dst, optimize=True)
+    os.rename(tmp_dst, dst)
+
+
+class ImageDerivativeProcessor:
+    """
+    generates resized and re-encoded copies of media images
+    at the configured widths.
+
+    derivatives are stored in a content-addressed cache directory
+    (source digest, width and, for lossy formats, quality make up the file name),
+    so an unchanged image is never processed twice.
+    missing derivatives are generated in parallel on all cores.
+
+    each derivative becomes a media item of its own, e.g.
+    media:weavy-logo.png -> media:weavy-logo.320w.png
+    """
+    IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".webp"]
+    LOSSY_EXTENSIONS = [".jpg", ".jpeg", ".webp"]
+
+    def __init__(self, cache_dir, file_digest_cache, widths, quality):
+        self.cache_dir = cache_dir
+        self.digests = file_digest_cache
+        self.widths = sorted(widths)
+        self.quality = quality
+        self.sizes_filename = os.path.join(cache_dir, "image_sizes.json")
+        self.sizes = {} #source digest -> [width, height]
+        self.derivatives = {} #source media name -> [(width, media name)]
+
+    def process(self, media_data):
+        if Image is None:
+            raise WeavyError('image derivatives need the Python Imaging Library (Pillow)')
+        self.__load_sizes()
+
+        jobs = []
+        new_items = []
+        for media_item in media_data.get_medias():
+            base, ext = os.path.splitext(media_item.name.name)
+            if ext.lower() not in self.IMAGE_EXTENSIONS:
+                continue
+            digest = self.digests.get_digest(media_item.path)
+            orig_width = self.__get_size(digest, media_item.path)[0]
+            srcset = []
+            for width in self.widths:
+                if width >= orig_width:
+                    break
+                cache_filename = os.path.join(self.cache_dir, self.__cache_name(digest, width, ext))
+                if not os.path.isfile(cache_filename):
+                    jobs.append( (media_item.path, cache_filename, width, self.quality) )
+                derivative = SiteItem()
+                derivative.set_name_from_filename(SiteCategories.MEDIA, '%s.%dw%s' % (base, width, ext))
+                derivative.path = cache_filename
+                new_items.append(derivative)
+                srcset.append( (width, derivative.name.name) )
+            srcset.append( (orig_width, media_item.name.name) )
+            self.derivatives[media_item.name.name] = srcset
+
+        if len(jobs) > 0:
+            log('generating %d image derivatives...' % len(jobs))
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            executor = make_process_executor()
+            if executor is None:
+                list(map(_make_image_derivative, jobs))
+            else:
+                with executor:
+                    list(executor.map(_make_image_derivative, jobs))
+
+        for derivative in new_items:
+            media_data.add_media(derivative)
+        self.__save_sizes()
+
+    def get_derivatives(self):
+        return self.derivatives
+
+    def __cache_name(self, digest, width, ext):
+        if ext.lower() in self.LOSSY_EXTENSIONS:
+            return '%s.%dw.q%d%s' % (digest, width, self.quality, ext)
+        return '%s.%dw%s' % (digest, width, ext)
+
+    def __get_size(self, digest, path):
+        if digest not in self.sizes:
+            image = Image.open(path)
+            self.sizes[digest] = list(image.size)
+        return self.sizes[digest]
+
+    def __load_sizes(self):
+        if os.path.isfile(self.sizes_filename):
+            self.sizes = json.loads(read_file(self.sizes_filename))
+
+    def __save_sizes(self):
+        mkpath_for_file(self.sizes_filename)
+        f = open(self.sizes_filename, "wb")
+        f.write(json.dumps(self.sizes, sort_keys=True).encode("utf8"))
+        f.close()
+
+
 class ItemNameResolver:
     def __init__(self, out_dir, base_url):
         self.out_dir = out_dir
         self.base_url = base_url
+        self.media_fingerprinter = None
+        self.image_derivatives = {} #media name -> [(width, media name)]
+
+    def set_media_fingerprinter(self, media_fingerprinter):
+        self.media_fingerprinter = media_fingerprinter
+
+    def set_image_derivatives(self, image_derivatives):
+        self.image_derivatives = image_derivatives
 
     def _get_outdir_path(self, item_name):
         if item_name.category == SiteCategories.BLOG:
@@ -479,11 +1114,17 @@ class ItemNameResolver:
             return '%s.html' % item_name.name
 
         if item_name.category == SiteCategories.MEDIA:
-            return os.path.join("media", item_name.name)
+            media_name = item_name.name
+            if self.media_fingerprinter:
+                media_name = self.media_fingerprinter.get_fingerprinted_name(media_name)
+            return os.path.join("media", media_name)
 
         if item_name.category == SiteCategories.FEEDS:
             return os.path.join("feeds", '%s.xml' % item_name.name)
 
+        if item_name.category == SiteCategories.SITEMAPS:
+            return '%s.xml' % item_name.name
+
     def get_abs_path(self, item_name):
         return os.path.join(self.out_dir, self._get_outdir_path(item_name))
 
@@ -498,6 +1139,30 @@ class ItemNameResolver:
     def get_rel_path_http(self, item_name, rel_to):
         return self.get_rel_path(item_name, rel_to).replace("\\", "/")
     
+    def get_state_digest(self):
+        """
+        @return a digest of everything that influences how item names are resolved
+        """
+        fingerprinted_names = {}
+        if self.media_fingerprinter:
+            fingerprinted_names = self.media_fingerprinter.fingerprinted_names
+        state = [self.base_url, fingerprinted_names, self.image_derivatives]
+        return hashlib.sha1( json.dumps(state, sort_keys=True).encode("utf8") ).hexdigest()
+
+    def get_srcset_http(self, item_name, rel_to):
+        """
+        @param item_name a srcset: item name, e.g. srcset:weavy-logo.png
+        @return a srcset attribute value listing all derivatives of the image
+        """
+        media_name = ItemName.from_parts(SiteCategories.MEDIA, item_name.name)
+        if item_name.name not in self.image_derivatives:
+            return self.get_rel_path_http(media_name, rel_to)
+        candidates = []
+        for width, derivative_name in self.image_derivatives[item_name.name]:
+            derivative_iname = ItemName.from_parts(SiteCategories.MEDIA, derivative_name)
+            candidates.append( '%s %dw' % (self.get_rel_path_http(derivative_iname, rel_to), width) )
+        return ', '.join(candidates)
+
     def get_abs_url(self, item_name):
         return '%s%s' % (self.base_url, self._get_outdir_path(item_name))
 
@@ -543,6 +1208,17 @@ class NavigationRenderer:
     def make_navigation(self, from_item_name):
         tree = self.__make_nav_tree()
         return self.__recursive_render(tree, from_item_name)
+
+    def get_node_names(self):
+        """
+        @return sorted item name strings the navigation links to,
+            they change whenever a navigation node is added or removed
+        """
+        node_names = set( ["%s:index" % SiteCategories.BLOG] )
+        for page in self.ds.pages.get_pages():
+            for _, linked_page in self.__name_to_visual_path(page.name):
+                node_names.add(str(linked_page))
+        return sorted(node_names)
     
     def __recursive_render(self, root_node, from_item_name):
         children = root_node.get_children()
@@ -591,19 +1267,26 @@ class NavigationRenderer:
 def mkpath_for_file(filename):
     path = os.path.dirname(filename)
     if not os.path.exists(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
 
 class RawOutputTarget:
     def write_file(self, filename, content):
+        self.write_stream(filename, [content])
+
+    def write_stream(self, filename, chunks):
         mkpath_for_file(filename)
         f = open(filename, "wb")
-        f.write(content)
+        for chunk in chunks:
+            f.write(chunk)
         f.close()
 
     def copy_file(self, src, dst):
         mkpath_for_file(dst)
         shutil.copy(src, dst)
+
+    def is_gzipped(self, filename):
+        return False
             
 class GzipStaticOutputTarget:
     def __init__(self, gzip_file_extensions):
@@ -611,23 +1294,38 @@ class GzipStaticOutputTarget:
         self.rawout = RawOutputTarget()
 
     def write_file(self, filename, content):
-        self.rawout.write_file(filename, content)
-        if self._is_gzip_file(filename):
-            gzip_filename = self._gzip_filename(filename)
-            f = gzip.GzipFile(gzip_filename, "wb", 9)
-            f.write(content)
-            f.close()
+        self.write_stream(filename, [content])
+
+    def write_stream(self, filename, chunks):
+        """
+        write the raw file and its compressed variant side by side,
+        chunk by chunk
+        """
+        if not self._is_gzip_file(filename):
+            self.rawout.write_stream(filename, chunks)
+            return
+        mkpath_for_file(filename)
+        f = open(filename, "wb")
+        gzip_f = gzip.GzipFile(self._gzip_filename(filename), "wb", 9, mtime=0)
+        for chunk in chunks:
+            f.write(chunk)
+            gzip_f.write(chunk)
+        f.close()
+        gzip_f.close()
         
     def copy_file(self, src, dst):
         self.rawout.copy_file(src, dst)
         if self._is_gzip_file(dst):
             gzip_filename = self._gzip_filename(dst)
             in_file = open(src, "rb")
-            gzip_out_file = gzip.GzipFile(gzip_filename, "wb", 9)
+            gzip_out_file = gzip.GzipFile(gzip_filename, "wb", 9, mtime=0)
             shutil.copyfileobj(in_file, gzip_out_file)
             in_file.close()
             gzip_out_file.close()
 
+    def is_gzipped(self, filename):
+        return self._is_gzip_file(filename)
+
     def _is_gzip_file(self, filename):
         _,extension = os.path.splitext(filename)
         for e in self.gzip_file_extensions:
@@ -638,9 +1336,604 @@ class GzipStaticOutputTarget:
     def _gzip_filename(self, filename):
         return '%s.gz' % filename
 
+
+class OutputFilter:
+    """
+    base class for filters that transform the bytes of output files
+    before they are handed to the output target.
+    subclasses set name and file_extensions and implement _filter_text()
+    """
+    name = None
+    file_extensions = []
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def applies_to(self, filename):
+        _,extension = os.path.splitext(filename)
+        return extension[1:] in self.file_extensions
+
+    def filter(self, content):
+        try:
+            text = content.decode("utf8")
+        except UnicodeDecodeError:
+            return content
+        filtered_content = self._filter_text(text).encode("utf8")
+        self.bytes_in += len(content)
+        self.bytes_out += len(filtered_content)
+        return filtered_content
+
+    def get_bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    def _filter_text(self, text):
+        raise NotImplementedError()
+
+    def _filter_unprotected(self, text, protected_re, filter_fn, protected_fn=None):
+        """
+        apply filter_fn to the parts of text that are not matched by protected_re,
+        matched parts are passed through protected_fn if given
+        """
+        parts = []
+        pos = 0
+        for m in protected_re.finditer(text):
+            parts.append( filter_fn(text[pos:m.start()]) )
+            if protected_fn:
+                parts.append( protected_fn(m.group(0)) )
+            else:
+                parts.append( m.group(0) )
+            pos = m.end()
+        parts.append( filter_fn(text[pos:]) )
+        return ''.join(parts)
+
+
+def _collapse_whitespace(match):
+    if "\n" in match.group(0):
+        return "\n"
+    return " "
+
+class HtmlMinifyFilter(OutputFilter):
+    """
+    collapses whitespace runs and removes comments, but leaves
+    pre, code, textarea, script and style elements alone
+    """
+    name = "minify_html"
+    file_extensions = ["html", "htm"]
+    protected_re = re.compile(r'<(pre|code|textarea|script|style)\b.*?</\1\s*>', re.S | re.I)
+    comment_re = re.compile(r'<!--(?!\[if).*?-->', re.S)
+    whitespace_re = re.compile(r'[ \t\r\n\f]+')
+
+    def _filter_text(self, text):
+        return self._filter_unprotected(text, self.protected_re, self.__minify)
+
+    def __minify(self, text):
+        text = self.comment_re.sub('', text)
+        return self.whitespace_re.sub(_collapse_whitespace, text)
+
+class CssMinifyFilter(OutputFilter):
+    """
+    removes comments and whitespace that carries no meaning,
+    string literals are left alone
+    """
+    name = "minify_css"
+    file_extensions = ["css"]
+    token_re = re.compile(r'/\*.*?\*/|"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'', re.S)
+    whitespace_re = re.compile(r'[ \t\r\n\f]+')
+    punctuation_re = re.compile(r' ?([{};,>]) ?')
+
+    def _filter_text(self, text):
+        text = self._filter_unprotected(text, self.token_re, lambda t: t, self.__strip_comment)
+        return self._filter_unprotected(text, self.token_re, self.__minify).strip()
+
+    def __strip_comment(self, token):
+        if token.startswith("/*"):
+            return ""
+        return token
+
+    def __minify(self, text):
+        text = self.whitespace_re.sub(' ', text)
+        text = self.punctuation_re.sub(r'\1', text)
+        text = text.replace(': ', ':')
+        return text.replace(';}', '}')
+
+class XmlMinifyFilter(OutputFilter):
+    """
+    removes whitespace between tags, CDATA sections and comments are left alone
+    """
+    name = "minify_xml"
+    file_extensions = ["xml"]
+    protected_re = re.compile(r'<!\[CDATA\[.*?\]\]>|<!--.*?-->', re.S)
+    between_tags_re = re.compile(r'>[ \t\r\n]+<')
+
+    def _filter_text(self, text):
+        return self._filter_unprotected(text, self.protected_re, self.__minify).strip()
+
+    def __minify(self, text):
+        return self.between_tags_re.sub('><', text)
+
+OUTPUT_FILTERS = dict( (f.name, f) for f in [HtmlMinifyFilter, CssMinifyFilter, XmlMinifyFilter] )
+
+def make_output_filters(filter_names):
+    filters = []
+    for filter_name in filter_names:
+        if filter_name not in OUTPUT_FILTERS:
+            raise WeavyError('unknown output filter %s (known filters: %s)' % (filter_name, ', '.join(sorted(OUTPUT_FILTERS))))
+        filters.append( OUTPUT_FILTERS[filter_name]() )
+    return filters
+
+class FilteredOutputTarget:
+    """
+    runs the content of every output file through a chain of OutputFilters
+    before passing it on to the wrapped output target
+    (which writes it and optionally precompresses it)
+    """
+    def __init__(self, filters, target):
+        self.filters = filters
+        self.target = target
+
+    def write_file(self, filename, content):
+        self.write_stream(filename, [content])
+
+    def write_stream(self, filename, chunks):
+        """
+        filters are applied chunk by chunk, the renderer cuts pages
+        only between complete elements, so no protected element
+        (e.g. <pre>) is ever split across chunks
+        """
+        self.target.write_stream(filename, self.filter_stream(filename, chunks))
+
+    def filter_stream(self, filename, chunks):
+        """
+        @return the chunks run through the filters that apply to filename
+        """
+        filters = [ f for f in self.filters if f.applies_to(filename) ]
+        if len(filters) == 0:
+            return chunks
+        return self.__filter_chunks(filters, chunks)
+
+    def __filter_chunks(self, filters, chunks):
+        """
+        whitespace at the end of a filtered chunk is held back and filtered
+        again together with the next chunk, so whitespace runs across chunk
+        boundaries come out like in a file that is filtered in one piece
+        """
+        pending = b""
+        for chunk in chunks:
+            chunk = pending + chunk
+            for f in filters:
+                chunk = f.filter(chunk)
+            body = chunk.rstrip(b" \t\r\n\f")
+            pending = chunk[len(body):]
+            yield body
+        if len(pending) > 0:
+            for f in filters:
+                pending = f.filter(pending)
+            yield pending
+
+    def copy_file(self, src, dst):
+        if not self.is_filtered(dst):
+            self.target.copy_file(src, dst)
+            return
+        in_file = open(src, "rb")
+        content = in_file.read()
+        in_file.close()
+        self.write_file(dst, content)
+
+    def get_filters(self):
+        return self.filters
+
+    def is_gzipped(self, filename):
+        return self.target.is_gzipped(filename)
+
+    def is_filtered(self, filename):
+        for f in self.filters:
+            if f.applies_to(filename):
+                return True
+        return False
+
             
         
+class ArtifactStore:
+    """
+    content-addressed store for build artifacts (converted markdown,
+    rendered fragments and output files), each stored under a digest
+    of everything it was generated from.
+
+    the store is a plain directory that can be shared between machines,
+    either on a shared mount or by exporting and importing a tarball.
+    every lookup refreshes the mtime of the object, so objects no build
+    used for a while can be garbage collected.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, "objects")
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        """
+        @return the filename of the object stored under key or None
+        """
+        path = self.__object_path(key)
+        if not os.path.isfile(path):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass #read-only store, its objects are not garbage collected from here
+        self.hits += 1
+        return path
+
+    def get(self, key):
+        path = self.get_path(key)
+        if path is None:
+            return None
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def put(self, key, data):
+        for _ in self.tee(key, [data]):
+            pass
+
+    def tee(self, key, chunks):
+        """
+        pass chunks through while storing them under key,
+        the object only appears in the store once all chunks were seen.
+        the temporary file has a random name, process ids are not unique
+        among the machines (or containers) sharing a store
+        """
+        path = self.__object_path(key)
+        tmp_path = '%s.tmp-%s' % (path, uuid.uuid4().hex)
+        try:
+            mkpath_for_file(path)
+            f = open(tmp_path, "wb")
+        except OSError:
+            #read-only store, chunks are passed through without storing them
+            for chunk in chunks:
+                yield chunk
+            return
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        except:
+            f.close()
+            os.remove(tmp_path)
+            raise
+        f.close()
+        os.replace(tmp_path, path)
+
+    def collect_garbage(self, max_age_days):
+        """
+        remove all objects that were not used during the last max_age_days days
+        @return tuple (number of removed objects, number of freed bytes)
+        """
+        deadline = time.time() - max_age_days * 24 * 60 * 60
+        num_removed = 0
+        bytes_freed = 0
+        dirlst = DirectoryLister(self.objects_dir)
+        dirlst.collect()
+        for path in dirlst.get_files(relative=False):
+            stat = os.stat(path)
+            if stat.st_mtime < deadline:
+                os.remove(path)
+                num_removed += 1
+                bytes_freed += stat.st_size
+        return (num_removed, bytes_freed)
+
+    def export_archive(self, tarball):
+        archive = tarfile.open(tarball, "w:gz")
+        if os.path.isdir(self.objects_dir):
+            archive.add(self.objects_dir, arcname="objects")
+        archive.close()
+
+    def import_archive(self, tarball):
+        """
+        merge the objects of an exported store into this store
+        @return number of imported objects
+        """
+        archive = tarfile.open(tarball, "r:*")
+        num_imported = 0
+        for member in archive:
+            parts = member.name.split("/")
+            if not member.isfile() or len(parts) != 3 or parts[0] != "objects" or ".." in parts:
+                continue
+            path = os.path.join(self.objects_dir, parts[1], parts[2])
+            if os.path.isfile(path):
+                continue
+            data = archive.extractfile(member).read()
+            self.put('%s%s' % (parts[1], parts[2]), data)
+            num_imported += 1
+        archive.close()
+        return num_imported
+
+    def __object_path(self, key):
+        return os.path.join(self.objects_dir, key[:2], key[2:])
+
+
+class BuildState:
+    """
+    remembers the output files of the last build and a signature
+    of the inputs each of them was generated from.
+
+    outputs whose signature did not change are not regenerated,
+    outputs that were not produced again are stale and get removed.
+
+    every output is also appended to a journal right when it is written,
+    so the outputs of a build that crashed before save() are known to
+    the next build (which regenerates them or removes them as stale).
+    """
+    def __init__(self, out_dir, state_filename=None):
+        self.out_dir = out_dir
+        self.state_filename = state_filename
+        self.journal_filename = '%s.journal' % state_filename if state_filename else None
+        self.journal = None
+        self.signatures = {} #out dir relative filename -> signature of the last build
+        self.outputs = {} #out dir relative filename -> signature of this build
+        self.previous_navigation = None #navigation node names of the last build
+        self.navigation = None #navigation node names the outputs of this build show
+
+    def load(self):
+        """
+        @return True if the state of a previous build was found
+        """
+        if not self.state_filename or not os.path.isfile(self.state_filename):
+            return False
+        try:
+            state = json.loads(read_file(self.state_filename))
+            self.signatures = state["outputs"]
+            self.previous_navigation = state["navigation"]
+        except (ValueError, KeyError, TypeError):
+            log('ignoring broken build state %s' % self.state_filename)
+            self.signatures = {}
+            return False
+        self.__load_journal()
+        return True
+
+    def save(self):
+        if not self.state_filename:
+            return
+        mkpath_for_file(self.state_filename)
+        f = open(self.state_filename, "wb")
+        state = {"outputs":self.outputs, "navigation":self.navigation}
+        f.write(json.dumps(state, sort_keys=True).encode("utf8"))
+        f.close()
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if os.path.isfile(self.journal_filename):
+            os.remove(self.journal_filename)
+
+    def is_up_to_date(self, filename, signature):
+        return self.signatures.get(self.__rel(filename)) == signature and os.path.isfile(filename)
+
+    def get_outputs(self):
+        """
+        @return out dir relative filenames of all outputs of this build
+        """
+        return sorted(self.outputs)
+
+    def get_previous_navigation(self):
+        return self.previous_navigation
+
+    def set_navigation(self, node_names):
+        self.navigation = node_names
+
+    def add_output(self, filename, signature=None):
+        rel_filename = self.__rel(filename)
+        self.outputs[rel_filename] = signature
+        self.__journal(rel_filename)
+
+    def keep_previous_outputs(self):
+        """
+        keep the outputs of the last build that were not visited by this
+        (partial) build, so they are neither removed nor regenerated later
+        """
+        for rel_filename, signature in self.signatures.items():
+            self.outputs.setdefault(rel_filename, signature)
+
+    def remove_stale_outputs(self):
+        for rel_filename in self.signatures:
+            if rel_filename in self.outputs:
+                continue
+            for filename in [rel_filename, '%s.gz' % rel_filename]:
+                abs_filename = os.path.join(self.out_dir, filename)
+                if os.path.isfile(abs_filename):
+                    os.remove(abs_filename)
+            self.__remove_empty_dirs(os.path.dirname(os.path.join(self.out_dir, rel_filename)))
+
+    def __load_journal(self):
+        """
+        outputs in the journal were written by a build that did not finish,
+        their signature is unknown
+        """
+        if not os.path.isfile(self.journal_filename):
+            return
+        log('previous build did not finish, checking its outputs')
+        for rel_filename in read_file(self.journal_filename).splitlines():
+            if rel_filename:
+                self.signatures[rel_filename] = None
+
+    def __journal(self, rel_filename):
+        if not self.journal_filename:
+            return
+        if not self.journal:
+            mkpath_for_file(self.journal_filename)
+            self.journal = open(self.journal_filename, "ab")
+        self.journal.write(('%s\n' % rel_filename).encode("utf8"))
+        self.journal.flush()
+
+    def __remove_empty_dirs(self, path):
+        out_dir = os.path.abspath(self.out_dir)
+        path = os.path.abspath(path)
+        while path != out_dir and path.startswith(out_dir) and os.path.isdir(path) and len(os.listdir(path)) == 0:
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+    def __rel(self, filename):
+        return os.path.relpath(filename, self.out_dir).replace("\\", "/")
+
+
+class HeaderManifestWriter:
+    """
+    writes a manifest of precomputed caching headers for every output file
+    (ETag from a content hash, Last-Modified, content type, Cache-Control from
+    a cache class) and optionally nginx and Apache snippets that apply the
+    Cache-Control headers, so the web server does not need to guess.
+
+    web servers answer conditional requests with validators computed from
+    the file mtime (and size), so the mtime of every output is set to its
+    Last-Modified: the item metadata for new bytes, the time of the last
+    manifest that listed the same bytes for unchanged ones, and the build
+    time if the bytes changed but the metadata did not. rewriting an
+    unchanged file (e.g. a cold build from the artifact store) thus keeps
+    its validators, changed bytes always get new ones.
+    """
+    CACHE_CONTROL = {
+        "immutable": "public, max-age=31536000, immutable", #only for content-fingerprinted urls
+        "archive": "public, max-age=604800, must-revalidate",
+        "media": "public, max-age=86400",
+        "feed": "public, max-age=900, must-revalidate",
+        "document": "no-cache"
+    }
+    SNIPPETS = ["nginx", "apache"]
+
+    def __init__(self, out_dir, base_url, file_digest_cache):
+        self.out_dir = out_dir
+        self.url_path = urlparse(base_url).path or "/"
+        self.digests = file_digest_cache
+
+    def write(self, manifest_dir, output_items, output_filenames, snippets):
+        """
+        @param output_items map out dir relative filename -> (item name, last modified, cache class)
+        @param output_filenames out dir relative filenames of all outputs
+        @param snippets list of server snippets to generate (nginx, apache)
+        """
+        for snippet in snippets:
+            if snippet not in self.SNIPPETS:
+                raise WeavyError('unknown header snippet %s (known snippets: %s)' % (snippet, ', '.join(self.SNIPPETS)))
+
+        previous_entries = self.__load_previous_entries(os.path.join(manifest_dir, "manifest.json"))
+        now = int(time.time())
+        entries = []
+        for rel_filename in output_filenames:
+            item_name, last_modified, cache_class = output_items.get(rel_filename, (None, None, "document"))
+            for variant in [rel_filename, '%s.gz' % rel_filename]:
+                abs_filename = os.path.join(self.out_dir, variant)
+                if os.path.isfile(abs_filename):
+                    entry = self.__make_entry(variant, rel_filename, item_name, cache_class)
+                    entry["mtime"] = self.__get_mtime(entry, last_modified, previous_entries.get(variant), now)
+                    entry["last_modified"] = email_utils.formatdate(entry["mtime"], usegmt=True)
+                    self.digests.set_mtime(abs_filename, entry["mtime"])
+                    entries.append(entry)
+
+        self.__write_file(os.path.join(manifest_dir, "manifest.json"), json.dumps(entries, indent=1, sort_keys=True))
+        if "nginx" in snippets:
+            self.__write_file(os.path.join(manifest_dir, "nginx.conf"), self.__make_nginx_snippet(entries))
+        if "apache" in snippets:
+            self.__write_file(os.path.join(manifest_dir, "apache.conf"), self.__make_apache_snippet(entries))
+        return len(entries)
+
+    def __load_previous_entries(self, manifest_filename):
+        """
+        @return map path -> entry of the manifest written by the last build
+        """
+        if not os.path.isfile(manifest_filename):
+            return {}
+        try:
+            return dict( (entry["path"], entry) for entry in json.loads(read_file(manifest_filename)) )
+        except (ValueError, KeyError, TypeError):
+            log('ignoring broken header manifest %s' % manifest_filename)
+            return {}
+
+    def __get_mtime(self, entry, last_modified, previous_entry, now):
+        """
+        @return unix time the file and its Last-Modified header are set to
+        """
+        previous_mtime = previous_entry.get("mtime") if previous_entry else None
+        if previous_mtime and previous_entry.get("sha1") == entry["sha1"]:
+            return previous_mtime
+        mtime = int(time.mktime(last_modified.timetuple())) if last_modified else now
+        if previous_mtime and mtime <= previous_mtime:
+            mtime = max(now, previous_mtime + 1)
+        return mtime
+
+    def __make_entry(self, filename, rel_filename, item_name, cache_class):
+        abs_filename = os.path.join(self.out_dir, filename)
+        digest = self.digests.get_digest(abs_filename)
+        content_type, encoding = mimetypes.guess_type(rel_filename)
+        content_type = content_type or "application/octet-stream"
+        if content_type.startswith("text/") or content_type.endswith("xml"):
+            content_type += "; charset=utf-8"
+        entry = {
+            "path": filename,
+            "url": self.url_path + rel_filename,
+            "item": str(item_name) if item_name else None,
+            "size": os.path.getsize(abs_filename),
+            "sha1": digest,
+            "etag": '"%s"' % digest[:16],
+            "content_type": content_type,
+            "cache_class": cache_class,
+            "cache_control": self.CACHE_CONTROL[cache_class]
+        }
+        if filename != rel_filename:
+            entry["content_encoding"] = "gzip"
+        return entry
+
+    def __make_nginx_snippet(self, entries):
+        lines = [
+            '# generated by weavy, include this in the http block and add',
+            '#     add_header Cache-Control $weavy_cache_control;',
+            '# to the server block of the site.',
+            '# ETag and Last-Modified are left to nginx: weavy sets the mtime of every',
+            '# output to its Last-Modified from manifest.json, so the validators nginx',
+            '# computes from mtime and size only change when the content does',
+            'map $uri $weavy_cache_control {',
+            '    default "%s";' % self.CACHE_CONTROL["document"]
+        ]
+        for url, cache_class in self.__urls_by_class(entries):
+            lines.append( '    "%s" "%s";' % (url, self.CACHE_CONTROL[cache_class]) )
+        lines.append('}')
+        return os.linesep.join(lines) + os.linesep
+
+    def __make_apache_snippet(self, entries):
+        lines = [
+            '# generated by weavy, include this in the virtual host of the site (needs mod_headers).',
+            '# ETag and Last-Modified are left to Apache (keep FileETag at its default MTime Size):',
+            '# weavy sets the mtime of every output to its Last-Modified from manifest.json,',
+            '# so the validators only change when the content does',
+            'Header set Cache-Control "%s"' % self.CACHE_CONTROL["document"]
+        ]
+        for url, cache_class in self.__urls_by_class(entries):
+            lines.append( '<Location "%s">' % url )
+            lines.append( '    Header set Cache-Control "%s"' % self.CACHE_CONTROL[cache_class] )
+            lines.append( '</Location>' )
+        return os.linesep.join(lines) + os.linesep
+
+    def __urls_by_class(self, entries):
+        """
+        @return sorted (url, cache class) tuples of all urls that are not plain documents
+        """
+        urls = set()
+        for entry in entries:
+            if entry["cache_class"] != "document":
+                urls.add( (entry["url"], entry["cache_class"]) )
+        return sorted(urls)
+
+    def __write_file(self, filename, content):
+        mkpath_for_file(filename)
+        f = open(filename, "wb")
+        f.write(content.encode("utf8"))
+        f.close()
+
+
 class SiteRenderer:
+    SITEMAP_MAX_URLS = 50000
+
     def __init__(self, item_name_resolver, data_sources, micro_template_engine, site_config):
         self.inr = item_name_resolver
         self.blog = data_sources.blog
@@ -650,15 +1943,234 @@ class SiteRenderer:
         self.config = site_config
         self.navR = NavigationRenderer(self.inr, data_sources, self.mte)
         if self.config.get_gzip_static():
-            self.otarget = GzipStaticOutputTarget(self.config.get_gzip_static())
+            self.unfiltered_target = GzipStaticOutputTarget(self.config.get_gzip_static())
         else:
-            self.otarget = RawOutputTarget()
-            
+            self.unfiltered_target = RawOutputTarget()
+        self.otarget = self.unfiltered_target
+        self.ofilters = make_output_filters(self.config.get_output_filters())
+        if len(self.ofilters) > 0:
+            self.otarget = FilteredOutputTarget(self.ofilters, self.unfiltered_target)
+        self.build_state = BuildState(self.inr.out_dir)
+        self.artifact_store = None
+        self.base_signature = self._make_base_signature(data_sources)
+        self.content_digests = {} #item name string -> digest of the content
+        self.num_up_to_date = 0
+        self.num_from_store = 0
+        self.selected_outputs = None #item name strings of the outputs to render, None renders all
+        self.media_outputs = None #see _get_media_outputs()
+        self.output_items = None #see get_output_items()
+        self.sitemaps = None #see _get_sitemaps()
+
+    def set_build_state(self, build_state):
+        self.build_state = build_state
+
+    def set_artifact_store(self, artifact_store):
+        self.artifact_store = artifact_store
     
     def render(self):
         self._render_blog()
         self._render_pages()
         self._render_media()
+        self._render_sitemaps()
+        self.build_state.set_navigation(self.navR.get_node_names())
+        self.build_state.remove_stale_outputs()
+        self._log_stats()
+
+    def render_selected(self, selector, with_dependents=False):
+        """
+        render only the outputs of items matched by selector, with_dependents
+        also renders the outputs that show the matched items: blog pages,
+        feed, archives and neighbouring posts of matched posts and every
+        output that references matched media.
+        all other outputs are left untouched.
+        """
+        self.selected_outputs = self._select_outputs(selector, with_dependents)
+        log('rendering %d selected outputs...' % len(self.selected_outputs))
+        #the navigation is only up to date once every html output shows it
+        if self.__selects_all_html():
+            self.build_state.set_navigation(self.navR.get_node_names())
+        else:
+            self.build_state.set_navigation(self.build_state.get_previous_navigation())
+        self._load_selected_contents()
+        self._render_blog()
+        self._render_pages()
+        self._render_media()
+        self._render_sitemaps()
+        self.build_state.keep_previous_outputs()
+        self.selected_outputs = None
+        self._log_stats()
+
+    def _is_selected(self, item_name):
+        return self.selected_outputs is None or str(item_name) in self.selected_outputs
+
+    def _select_outputs(self, selector, with_dependents):
+        posts = self.blog.get_posts()
+        pages = self.pages.get_pages()
+        item_names = [ item.name for item in posts + pages + self.media.get_medias() ]
+        item_names.extend( self.get_generated_item_names() )
+        selected = set( [str(n) for n in item_names if selector.matches(n)] )
+        if not with_dependents:
+            return selected
+
+        #every html output shows the navigation
+        if self.build_state.get_previous_navigation() != self.navR.get_node_names():
+            selected.update( [str(n) for n in self.__get_html_item_names(item_names)] )
+
+        #items that reference selected media, a reference to a media item
+        #changes with it (fingerprinted names, srcset derivatives)
+        for _, references in self.mte.get_template_references().items():
+            if self.__references_any(references, selected):
+                return set( [str(n) for n in item_names] )
+        for item in posts + pages:
+            if self.__references_any(item.references, selected):
+                selected.add(str(item.name))
+
+        #outputs that show selected posts
+        changed_posts = [ post for post in posts if str(post.name) in selected ]
+        if len(changed_posts) == 0:
+            return selected
+        changed_names = set( [str(post.name) for post in changed_posts] )
+        for page_posts, this_page_iname, _, _ in self._get_blog_pages(posts):
+            if len(changed_names.intersection( [str(p.name) for p in page_posts] )) > 0:
+                selected.add(str(this_page_iname))
+        for feed_posts, feed_iname, _, _ in self._get_feed_documents(posts):
+            if len(changed_names.intersection( [str(p.name) for p in feed_posts] )) > 0:
+                selected.add(str(feed_iname))
+        for sitemap_iname in self._get_sitemap_inames():
+            selected.add(str(sitemap_iname))
+        for post in changed_posts:
+            selected.add(str(self._archive_iname(post.created.year)))
+            selected.add(str(self._archive_iname(post.created.year, post.created.month)))
+            for neighbour in self.blog.get_neighbours(post):
+                if neighbour is not None:
+                    selected.add(str(neighbour.name))
+        return selected
+
+    def __references_any(self, references, item_name_strs):
+        """
+        @return True if references contain a media or srcset reference to one of item_name_strs
+        """
+        for item_name_str, _ in references:
+            item_name = ItemName.from_str(item_name_str)
+            if item_name.category == SiteCategories.SRCSET:
+                item_name = ItemName.from_parts(SiteCategories.MEDIA, item_name.name)
+            elif item_name.category != SiteCategories.MEDIA:
+                continue
+            if str(item_name) in item_name_strs:
+                return True
+        return False
+
+    def __get_html_item_names(self, item_names):
+        return [ n for n in item_names if n.category in (SiteCategories.BLOG, SiteCategories.PAGES) ]
+
+    def __selects_all_html(self):
+        posts = self.blog.get_posts()
+        item_names = [ item.name for item in posts + self.pages.get_pages() ]
+        item_names.extend( self.get_generated_item_names() )
+        for item_name in self.__get_html_item_names(item_names):
+            if str(item_name) not in self.selected_outputs:
+                return False
+        return True
+
+    def _load_selected_contents(self):
+        """
+        load the content of items that were loaded with metadata only
+        but are shown by a selected output
+        """
+        posts = self.blog.get_posts()
+        shown_posts = [ post for post in posts if self._is_selected(post.name) ]
+        for page_posts, this_page_iname, _, _ in self._get_blog_pages(posts):
+            if self._is_selected(this_page_iname):
+                shown_posts.extend(page_posts)
+        for feed_posts, feed_iname, _, _ in self._get_feed_documents(posts):
+            if self._is_selected(feed_iname):
+                shown_posts.extend(feed_posts)
+        for post in shown_posts:
+            if post.content is None:
+                self.blog.load_content(post)
+        for page in self.pages.get_pages():
+            if page.content is None and self._is_selected(page.name):
+                self.pages.load_content(page)
+
+    def _log_stats(self):
+        self._log_filter_stats()
+        if self.num_up_to_date > 0:
+            log('%d outputs were up to date' % self.num_up_to_date)
+        if self.num_from_store > 0:
+            log('%d outputs were taken from the artifact store' % self.num_from_store)
+
+    def _make_base_signature(self, data_sources):
+        """
+        digest of everything every output depends on:
+        weavy itself, site.conf, the templates, the name resolution
+        and the page names the navigation is built from
+        """
+        h = hashlib.sha1()
+        f = open(os.path.abspath(__file__), "rb")
+        h.update(f.read())
+        f.close()
+        h.update(self.config.get_digest().encode("utf8"))
+        h.update(self.mte.get_templates_digest().encode("utf8"))
+        h.update(self.inr.get_state_digest().encode("utf8"))
+        page_names = sorted( [str(p.name) for p in data_sources.pages.get_pages()] )
+        h.update(os.linesep.join(page_names).encode("utf8"))
+        return h.hexdigest()
+
+    def _make_signature(self, *parts):
+        h = hashlib.sha1(self.base_signature.encode("utf8"))
+        for part in parts:
+            h.update(str(part).encode("utf8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def _post_key(self, post):
+        """
+        @return everything about a post that ends up in rendered output
+        """
+        name = str(post.name)
+        if name not in self.content_digests:
+            self.content_digests[name] = hashlib.sha1(post.content.encode("utf8")).hexdigest()
+        return (name, post.title, post.created, post.author, post.tags, self.content_digests[name])
+
+    def _reuse_output(self, filename, signature):
+        """
+        @return True if an output generated from the same inputs exists,
+            either in the output dir from an earlier build (it is kept)
+            or in the artifact store (it is written from there)
+        """
+        if self.build_state.is_up_to_date(filename, signature):
+            self.build_state.add_output(filename, signature)
+            self.num_up_to_date += 1
+            return True
+        if self.artifact_store is None:
+            return False
+        path = self.artifact_store.get_path(signature)
+        if path is None:
+            return False
+        #stored outputs are already filtered
+        self.unfiltered_target.write_stream(filename, read_chunks(path))
+        self._remove_stale_gzip(filename)
+        self.build_state.add_output(filename, signature)
+        self.num_from_store += 1
+        return True
+
+    def _render_fragment(self, render_fn, *key_parts):
+        """
+        @return the result of render_fn(), taken from the artifact store if possible
+        """
+        if self.artifact_store is None:
+            return render_fn()
+        key = self._make_signature('fragment', *key_parts)
+        fragment = self.artifact_store.get(key)
+        if fragment is not None:
+            return fragment.decode("utf8")
+        fragment = render_fn()
+        self.artifact_store.put(key, fragment.encode("utf8"))
+        return fragment
+
+    def _log_filter_stats(self):
+        for f in self.ofilters:
+            log('%s: saved %d of %d bytes' % (f.name, f.get_bytes_saved(), f.bytes_in))
 
     def _render_blog(self):
         posts = self.blog.get_posts()
@@ -667,11 +2179,12 @@ class SiteRenderer:
 
         self._render_blog_htmlview(posts)
         self._render_blog_rssview(posts)
+        self._render_blog_archives()
 
-    def _partition_posts(self, posts):
+    def _partition_posts(self, posts, posts_per_page=None):
         """
         given a list of posts
-        and a posts_per_page value n in the site config,
+        and a posts_per_page value n (from the site config if not given),
         this method will partition the posts into pages such that:
             - the main_partition contains the n newest (first) posts
             - older posts are split in chunks of n posts from the back
@@ -695,7 +2208,8 @@ class SiteRenderer:
         @param posts a list of posts
         @return tuple (index_posts, older_posts) where index_posts is a list of posts and older posts is a list of lists of posts
         """
-        posts_per_page = self.config.get_blog_posts_per_page()
+        if posts_per_page is None:
+            posts_per_page = self.config.get_blog_posts_per_page()
         #posts = [1,2,3,4,5,6,7,8,9]
         num_posts = len(posts)
         main_partition = posts[0:posts_per_page]
@@ -714,7 +2228,181 @@ class SiteRenderer:
 
 
 
+    def get_generated_item_names(self):
+        """
+        @return the names of all items the renderer generates in addition to
+            the items of the data sources (pagination, feeds, archives)
+        """
+        posts = self.blog.get_posts()
+        item_names = [ this_page_iname for _, this_page_iname, _, _ in self._get_blog_pages(posts) ]
+        item_names.extend( [ feed_iname for _, feed_iname, _, _ in self._get_feed_documents(posts) ] )
+        item_names.extend( [ archive_iname for archive_iname, _, _, _, _ in self._get_archives() ] )
+        item_names.extend( self._get_sitemap_inames() )
+        return item_names
+
+    def get_output_items(self):
+        """
+        @return map out dir relative filename -> (item name, last modified, cache class)
+            for the outputs of all items the site consists of
+        """
+        if self.output_items is None:
+            self._make_output_layout()
+        return self.output_items
+
+    def _get_sitemaps(self):
+        """
+        @return tuple (index_iname, sitemaps), sitemaps is a list of (sitemap_iname, entries)
+            tuples and entries a list of (url, last modified) tuples,
+            index_iname is None if all urls fit into a single sitemap
+        """
+        if self.output_items is None:
+            self._make_output_layout()
+        return self.sitemaps
+
+    def _make_output_layout(self):
+        """
+        work out the outputs of all items and the sitemaps listing them,
+        once per build (the data sources do not change while rendering)
+        """
+        output_items = {}
+        sitemap_entries = [] #(born, url, last modified)
+        sitemap_categories = [SiteCategories.BLOG, SiteCategories.PAGES, SiteCategories.FEEDS]
+        def _add(item_name, last_modified, cache_class, born=None):
+            rel_filename = os.path.relpath(self.inr.get_abs_path(item_name), self.inr.out_dir).replace("\\", "/")
+            output_items[rel_filename] = (item_name, last_modified, cache_class)
+            if item_name.category in sitemap_categories:
+                sitemap_entries.append( (born, self.inr.get_abs_url(item_name), last_modified) )
+        def _oldest(posts):
+            return posts[-1].created if len(posts) > 0 else None
+
+        posts = self.blog.get_posts()
+        for item in posts + self.pages.get_pages():
+            _add(item.name, self._last_modified(item), "document", item.created)
+        media_cache_class = "immutable" if self.config.get_media_fingerprint() else "media"
+        for media_item in self.media.get_medias():
+            _add(media_item.name, self._last_modified(media_item), media_cache_class)
+        blog_index_iname = ItemName.from_parts(SiteCategories.BLOG, "index")
+        for page_posts, this_page_iname, _, _ in self._get_blog_pages(posts):
+            #the posts of the blog index change with every new post, older pages keep theirs
+            born = None if str(this_page_iname) == str(blog_index_iname) else _oldest(page_posts)
+            _add(this_page_iname, self._newest_change(page_posts), "document", born)
+        for feed_posts, feed_iname, _, is_archive in self._get_feed_documents(posts):
+            born = _oldest(feed_posts) if is_archive else None
+            _add(feed_iname, self._newest_change(feed_posts), "archive" if is_archive else "feed", born)
+        for archive_iname, _, start, end, _ in self._get_archives():
+            _add(archive_iname, self._newest_change(self.blog.get_posts_between(start, end)), "document", start)
+
+        self.sitemaps = self._make_sitemaps(sitemap_entries)
+        index_iname, sitemaps = self.sitemaps
+        for sitemap_iname, entries in sitemaps:
+            _add(sitemap_iname, max([ last_modified for _, last_modified in entries ]), "feed")
+        if index_iname:
+            _add(index_iname, max([ max([ lm for _, lm in entries ]) for _, entries in sitemaps ]), "feed")
+        self.output_items = output_items
+
+    def _make_sitemaps(self, sitemap_entries):
+        """
+        split the urls of all posts, pages, blog pages, archives and feeds
+        into sitemaps of at most SITEMAP_MAX_URLS urls.
+
+        urls are ordered by the date their item came into being (a post's
+        creation, the oldest post of an older blog page or feed archive, the
+        start of an archive's period) and sitemaps are filled from the oldest
+        url on, so a new url only ever goes into the last sitemaps and an
+        edit only changes the last modified date inside its sitemap.
+        urls without such a date (the blog index, the feed, pages without a
+        created date) come last, ordered by url.
+
+        @param sitemap_entries list of (born, url, last modified) tuples, born may be None
+        @return tuple (index_iname, sitemaps) as returned by _get_sitemaps()
+        """
+        if not self.config.get_sitemap():
+            return (None, [])
+        known = [ last_modified for _, _, last_modified in sitemap_entries if last_modified ]
+        newest = max(known) if len(known) > 0 else datetime.datetime(1970, 1, 1)
+        sitemap_entries = sorted(sitemap_entries, key = lambda e: (e[0] is None, e[0] or datetime.datetime.min, e[1]))
+        entries = [ (url, last_modified or newest) for _, url, last_modified in sitemap_entries ]
+
+        sitemap_iname = ItemName.from_parts(SiteCategories.SITEMAPS, "sitemap")
+        if len(entries) <= self.SITEMAP_MAX_URLS:
+            return (None, [ (sitemap_iname, entries) ])
+        sitemaps = []
+        for i in range(0, len(entries), self.SITEMAP_MAX_URLS):
+            shard_iname = ItemName.from_parts(SiteCategories.SITEMAPS, 'sitemap-%d' % len(sitemaps))
+            sitemaps.append( (shard_iname, entries[i:i+self.SITEMAP_MAX_URLS]) )
+        return (sitemap_iname, sitemaps)
+
+    def _get_sitemap_inames(self):
+        index_iname, sitemaps = self._get_sitemaps()
+        item_names = [ sitemap_iname for sitemap_iname, _ in sitemaps ]
+        if index_iname:
+            item_names.append(index_iname)
+        return item_names
+
+    def _render_sitemaps(self):
+        index_iname, sitemaps = self._get_sitemaps()
+        for sitemap_iname, entries in sitemaps:
+            self._render_sitemap(sitemap_iname, entries)
+        if index_iname:
+            refs = [ (sitemap_iname, max([ lm for _, lm in entries ])) for sitemap_iname, entries in sitemaps ]
+            self._render_sitemap_index(index_iname, refs)
+
+    def _render_sitemap(self, sitemap_iname, entries):
+        """
+        a sitemap is only rewritten when one of its entries changed
+        """
+        if not self._is_selected(sitemap_iname):
+            return
+        filename = self.inr.get_abs_path(sitemap_iname)
+        signature = self._make_signature('sitemap', sitemap_iname, entries)
+        if self._reuse_output(filename, signature):
+            return
+        urls_xml = []
+        for url, last_modified in entries:
+            urls_xml.append( self.mte.render_sitemap_url(sitemap_iname, xml_escape(url), self._make_w3c_datetime(last_modified)) )
+        self._write_file(filename, self.mte.render_sitemap(sitemap_iname, ''.join(urls_xml)), signature)
+
+    def _render_sitemap_index(self, index_iname, refs):
+        if not self._is_selected(index_iname):
+            return
+        filename = self.inr.get_abs_path(index_iname)
+        ref_names = [ (str(sitemap_iname), last_modified) for sitemap_iname, last_modified in refs ]
+        signature = self._make_signature('sitemap_index', index_iname, ref_names)
+        if self._reuse_output(filename, signature):
+            return
+        refs_xml = []
+        for sitemap_iname, last_modified in refs:
+            url = self.inr.get_abs_url(sitemap_iname)
+            refs_xml.append( self.mte.render_sitemap_ref(index_iname, xml_escape(url), self._make_w3c_datetime(last_modified)) )
+        self._write_file(filename, self.mte.render_sitemap_index(index_iname, ''.join(refs_xml)), signature)
+
+    def _make_w3c_datetime(self, dt):
+        dt_stamp = time.mktime(dt.timetuple())
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(dt_stamp))
+
+    def _last_modified(self, item):
+        if item.last_changed:
+            return item.last_changed
+        if item.created:
+            return item.created
+        return datetime.datetime.fromtimestamp( os.path.getmtime(item.path) )
+
+    def _newest_change(self, items):
+        last_modified = [ self._last_modified(item) for item in items ]
+        if len(last_modified) == 0:
+            return None
+        return max(last_modified)
+
     def _render_blog_htmlview(self, posts):
+        for page_posts, this_page_iname, prev_page_iname, next_page_iname in self._get_blog_pages(posts):
+            self._render_blog_htmlview_page(page_posts, this_page_iname, prev_page_iname, next_page_iname)
+
+    def _get_blog_pages(self, posts):
+        """
+        @return list of (posts, this_page_iname, prev_page_iname, next_page_iname) tuples
+            for the blog index and all older blog pages
+        """
+        blog_pages = []
         main_partition,stable_partitions = self._partition_posts(posts)
         
         num_partitions = len(stable_partitions)
@@ -724,7 +2412,7 @@ class SiteRenderer:
             next_page_iname = ItemName.from_parts(SiteCategories.BLOG, 'page%d' % (num_partitions-1) )
         else:
             next_page_iname = blog_index_iname
-        self._render_blog_htmlview_page(main_partition, blog_index_iname, blog_index_iname, next_page_iname)
+        blog_pages.append( (main_partition, blog_index_iname, blog_index_iname, next_page_iname) )
 
         
         page_num = num_partitions-1
@@ -736,72 +2424,220 @@ class SiteRenderer:
             next_page_iname = this_page_iname
 
         for partition in stable_partitions:
-            self._render_blog_htmlview_page(partition, this_page_iname, prev_page_iname, next_page_iname)
+            blog_pages.append( (partition, this_page_iname, prev_page_iname, next_page_iname) )
             page_num -= 1
             prev_page_iname = this_page_iname
             this_page_iname = next_page_iname
             if page_num > 0:
                 next_page_iname = ItemName.from_parts(SiteCategories.BLOG, 'page%d' % (page_num-1))
 
-               
+        return blog_pages
+
 
     def _render_blog_htmlview_page(self, posts, this_page_iname, prev_page_iname, next_page_iname):
-        posts_html = []
-        for post in posts:
-            post_url = self.inr.get_rel_path_http(post.name, this_page_iname) 
-            post_datetime = self._make_post_date(post)
-            post_author = self._make_post_author(post)
-            post_tags = self._render_tags(this_page_iname, post)
-            post_content = self.mte.render_content(this_page_iname, post.content)
-            posts_html.append( self.mte.render_post(post.name, post.title, post_datetime, post_url, post_author, post_tags, post_content) )
-      
+        if not self._is_selected(this_page_iname):
+            return
+        filename = self.inr.get_abs_path(this_page_iname)
+        signature = self._make_signature('blog_page', this_page_iname, prev_page_iname, next_page_iname, \
+            self._newest_archive_iname(), [ self._post_key(post) for post in posts ])
+        if self._reuse_output(filename, signature):
+            return
+
         prev_page_url = self.inr.get_rel_path_http(prev_page_iname, this_page_iname)
         next_page_url = self.inr.get_rel_path_http(next_page_iname, this_page_iname)
         top_navigation = self.mte.render_blog_top_navigation(this_page_iname, prev_page_url, next_page_url)
         bottom_navigation = self.mte.render_blog_bottom_navigation(this_page_iname, prev_page_url, next_page_url)
 
-        blog_html = self.mte.render_blog(this_page_iname, os.linesep.join(posts_html), top_navigation, bottom_navigation)
+        archive_url = self.inr.get_rel_path_http(self._newest_archive_iname(), this_page_iname)
+        blog_head, blog_tail = self.mte.render_blog_segments(this_page_iname, top_navigation, bottom_navigation, archive_url)
 
         navigation_html = self.make_navigation(this_page_iname)
-        site_html = self.mte.render_site(this_page_iname, navigation_html, blog_html)
+        site_head, site_tail = self.mte.render_site_segments(this_page_iname, navigation_html)
 
-        filename = self.inr.get_abs_path(this_page_iname)
-        #print filename
-        self._write_file(filename, site_html)
+        def _render_post(post):
+            post_url = self.inr.get_rel_path_http(post.name, this_page_iname) 
+            post_datetime = self._make_post_date(post)
+            post_author = self._make_post_author(post)
+            post_tags = self._render_tags(this_page_iname, post)
+            post_content = self.mte.render_content(this_page_iname, post.content)
+            return self.mte.render_post(post.name, post.title, post_datetime, post_url, post_author, post_tags, post_content)
+
+        def _render_post_fragment(post):
+            return self._render_fragment(lambda: _render_post(post), 'blog_page_post', this_page_iname, self._post_key(post))
+
+        self._write_stream(filename, [site_head, blog_head], posts, _render_post_fragment, [blog_tail, site_tail], signature)
 
 
 
+    def _get_feed_documents(self, posts):
+        """
+        split the feed into paged and archived feed documents (RFC 5005):
+        the head feed feed:blog with the newest posts and archive documents
+        feed:blog/archiveN built from the same back-anchored partitions as the
+        blog pages, archive0 holding the oldest posts.
+        an archive links only to older archives and the head feed,
+        so it never changes once it is written.
+
+        @return list of (posts, feed_iname, links, is_archive) tuples,
+            links is a list of (rel, item name) tuples
+        """
+        head_posts, stable_partitions = self._partition_posts(posts, self.config.get_blog_posts_in_feeds())
+        head_iname = ItemName.from_parts(SiteCategories.FEEDS, "blog")
+        num_archives = len(stable_partitions)
+
+        head_links = [ ("current", head_iname) ]
+        if num_archives > 0:
+            head_links.append( ("prev-archive", self._feed_archive_iname(num_archives-1)) )
+        feed_documents = [ (head_posts, head_iname, head_links, False) ]
+
+        for i, partition in enumerate(stable_partitions):
+            archive_num = num_archives-1 - i
+            links = [ ("current", head_iname) ]
+            if archive_num > 0:
+                links.append( ("prev-archive", self._feed_archive_iname(archive_num-1)) )
+            feed_documents.append( (partition, self._feed_archive_iname(archive_num), links, True) )
+        return feed_documents
+
+    def _feed_archive_iname(self, archive_num):
+        return ItemName.from_parts(SiteCategories.FEEDS, 'blog/archive%d' % archive_num)
+
     def _render_blog_rssview(self, posts):
-        feed_iname = ItemName.from_parts(SiteCategories.FEEDS, "blog")
-        posts_xml = []
-        posts_in_feeds = self.config.get_blog_posts_in_feeds()
-        posts_to_render = posts[0:posts_in_feeds]
-        for post in posts_to_render:
+        for feed_posts, feed_iname, links, is_archive in self._get_feed_documents(posts):
+            self._render_feed(feed_posts, feed_iname, links, is_archive)
+
+    def _render_feed(self, posts_to_render, feed_iname, links, is_archive):
+        if not self._is_selected(feed_iname):
+            return
+        filename = self.inr.get_abs_path(feed_iname)
+        link_names = [ (rel, str(link_iname)) for rel, link_iname in links ]
+        signature = self._make_signature('feed', feed_iname, link_names, is_archive, [ self._post_key(post) for post in posts_to_render ])
+        if self._reuse_output(filename, signature):
+            return
+
+        def _render_post(post):
             post_url = self.inr.get_abs_url(post.name)
             post_author = self._make_post_author(post)
             post_datetime = self._make_post_date_rss(post)
             post_content = self.mte.render_content(feed_iname, post.content)
-            posts_xml.append( self.mte.render_post_rss(post.name, post.title, post_datetime, post_url, post_author, post_content) )
+            return self.mte.render_post_rss(post.name, post.title, post_datetime, post_url, post_author, post_content)
+
+        def _render_post_fragment(post):
+            return self._render_fragment(lambda: _render_post(post), 'feed_post', feed_iname, self._post_key(post))
+
+        feed_links_xml = []
+        if is_archive:
+            feed_links_xml.append( self.mte.render_feed_archive_marker(feed_iname) )
+        for rel, link_iname in links:
+            feed_links_xml.append( self.mte.render_feed_link(feed_iname, rel, self.inr.get_abs_url(link_iname)) )
 
-        feed_xml = self.mte.render_blog_rss(feed_iname, os.linesep.join(posts_xml), \
+        feed_head, feed_tail = self.mte.render_blog_rss_segments(feed_iname, \
             self.config.get_baseurl(), \
             self.config.get_site_title(), \
-            self.config.get_site_description() \
+            self.config.get_site_description(), \
+            ''.join(feed_links_xml) \
         )
-        filename = self.inr.get_abs_path(feed_iname)
-        self._write_file(filename, feed_xml)
+        self._write_stream(filename, [feed_head], posts_to_render, _render_post_fragment, [feed_tail], signature)
+
+    def _archive_iname(self, year, month=None):
+        if month is None:
+            return ItemName.from_parts(SiteCategories.BLOG, '%04d/index' % year)
+        return ItemName.from_parts(SiteCategories.BLOG, '%04d/%02d/index' % (year, month))
+
+    def _newest_archive_iname(self):
+        months = self.blog.get_months()
+        if len(months) == 0:
+            return ItemName.from_parts(SiteCategories.BLOG, "index")
+        return self._archive_iname(months[-1][0])
+
+    def _get_archives(self):
+        """
+        @return list of (archive_iname, title, start, end, year) tuples for all yearly
+            and monthly archives, posts created in [start, end) belong into the archive
+        """
+        archives = []
+        months = self.blog.get_months()
+        years = sorted(set( [year for year,_ in months] ))
+        for year in years:
+            archives.append( (self._archive_iname(year), '%04d' % year, \
+                datetime.datetime(year, 1, 1), datetime.datetime(year+1, 1, 1), year) )
+            for _,month in [ (y,m) for y,m in months if y == year ]:
+                if month == 12:
+                    end = datetime.datetime(year+1, 1, 1)
+                else:
+                    end = datetime.datetime(year, month+1, 1)
+                archives.append( (self._archive_iname(year, month), '%04d/%02d' % (year, month), \
+                    datetime.datetime(year, month, 1), end, year) )
+        return archives
+
+    def _render_blog_archives(self):
+        months = self.blog.get_months()
+        years = sorted(set( [year for year,_ in months] ))
+        for archive_iname, title, start, end, year in self._get_archives():
+            year_months = [ (y,m) for y,m in months if y == year ]
+            posts = self.blog.get_posts_between(start, end)
+            self._render_blog_archive(archive_iname, title, posts, years, year_months)
+
+    def _render_blog_archive(self, archive_iname, title, posts, years, months):
+        """
+        render a yearly or monthly archive page,
+        it is only regenerated when a post in its range or the list of archives changed
+        """
+        if not self._is_selected(archive_iname):
+            return
+        filename = self.inr.get_abs_path(archive_iname)
+        entries = [ (str(post.name), post.title, post.created) for post in posts ]
+        signature = self._make_signature('archive', archive_iname, title, entries, years, months)
+        if self._reuse_output(filename, signature):
+            return
+
+        links_html = []
+        for year in years:
+            year_url = self.inr.get_rel_path_http(self._archive_iname(year), archive_iname)
+            links_html.append( self.mte.render_link(archive_iname, year_url, '%04d' % year) )
+        for year,month in months:
+            month_url = self.inr.get_rel_path_http(self._archive_iname(year, month), archive_iname)
+            links_html.append( self.mte.render_link(archive_iname, month_url, '%04d/%02d' % (year, month)) )
+
+        entries_html = []
+        for post in posts:
+            post_url = self.inr.get_rel_path_http(post.name, archive_iname)
+            entries_html.append( self.mte.render_archive_entry(archive_iname, post.title, self._make_post_date(post), post_url) )
+
+        archive_html = self.mte.render_archive(archive_iname, title, os.linesep.join(links_html), os.linesep.join(entries_html))
+        site_html = self.mte.render_site(archive_iname, self.make_navigation(archive_iname), archive_html)
+        self._write_file(filename, site_html, signature)
+
+    def _render_post_navigation(self, post):
+        newer, older = self.blog.get_neighbours(post)
+        links = []
+        for neighbour in [newer, older]:
+            if neighbour is None:
+                links.append("")
+            else:
+                neighbour_url = self.inr.get_rel_path_http(neighbour.name, post.name)
+                links.append( self.mte.render_link(post.name, neighbour_url, neighbour.title) )
+        return self.mte.render_post_navigation(post.name, links[0], links[1])
 
     def _render_blog_post(self, post):
+        if not self._is_selected(post.name):
+            return
         filename = self.inr.get_abs_path(post.name)
+        newer, older = self.blog.get_neighbours(post)
+        neighbours = [ (str(n.name), n.title) for n in [newer, older] if n is not None ]
+        signature = self._make_signature('post', self._post_key(post), neighbours)
+        if self._reuse_output(filename, signature):
+            return
+
         post_datetime = self._make_post_date(post)
         post_url = self.inr.get_rel_path_http(post.name, post.name)
         post_author = self._make_post_author(post)
         post_tags = self._render_tags(post.name, post)
         post_content = self.mte.render_content(post.name, post.content)
         post_html = self.mte.render_post(post.name, post.title, post_datetime, post_url, post_author, post_tags, post_content)
+        post_html += os.linesep + self._render_post_navigation(post)
         page_html = self.mte.render_page(post.name, post_html)
         site_html = self.mte.render_site(post.name, self.make_navigation(post.name), page_html)
-        self._write_file(filename, site_html)
+        self._write_file(filename, site_html, signature)
 
     def _render_tags(self, from_item_name, post):
         tags_html = []
@@ -834,23 +2670,86 @@ class SiteRenderer:
             self._render_page(page)
 
     def _render_page(self, page):
+        if not self._is_selected(page.name):
+            return
         filename = self.inr.get_abs_path(page.name)
+        signature = self._make_signature('page', self._post_key(page))
+        if self._reuse_output(filename, signature):
+            return
+
         page_content = self.mte.render_content(page.name, page.content)
         page_html = self.mte.render_page(page.name, page_content)
         site_html = self.mte.render_site(page.name, self.make_navigation(page.name), page_html)
-        self._write_file(filename, site_html)
+        self._write_file(filename, site_html, signature)
 
     def _render_media(self):
         for media_item in self.media.get_medias():
+            if not self._is_selected(media_item.name):
+                continue
             filename = self.inr.get_abs_path(media_item.name)
             self._copy_file(media_item.path, filename)
 
-    def _write_file(self, filename, content):
-        encoded_content = content.encode("utf8")
-        self.otarget.write_file(filename, encoded_content)
+    def _write_file(self, filename, content, signature=None):
+        self._write_chunks(filename, [content.encode("utf8")], signature)
         
+    def _write_stream(self, filename, head, posts, render_post, tail, signature=None):
+        """
+        write head, the rendered posts (separated by line breaks) and tail
+        without ever holding the whole document in memory,
+        each post is rendered just before it is written
+        """
+        def _chunks():
+            for chunk in head:
+                yield chunk
+            for i, post in enumerate(posts):
+                if i > 0:
+                    yield os.linesep
+                yield render_post(post)
+            for chunk in tail:
+                yield chunk
+
+        self._write_chunks(filename, codecs.iterencode(_chunks(), "utf8"), signature)
+
+    def _write_chunks(self, filename, chunks, signature):
+        """
+        outputs with a signature are also put into the artifact store,
+        after filtering, so store hits can be written without filtering
+        them again (the filters need chunks cut between elements, the
+        stored bytes are read back in blocks of arbitrary size)
+        """
+        if self.artifact_store and signature:
+            if self.otarget is not self.unfiltered_target:
+                chunks = self.otarget.filter_stream(filename, chunks)
+            self.unfiltered_target.write_stream(filename, self.artifact_store.tee(signature, chunks))
+        else:
+            self.otarget.write_stream(filename, chunks)
+        self._remove_stale_gzip(filename)
+        self.build_state.add_output(filename, signature)
+
     def _copy_file(self, src, dst):
         self.otarget.copy_file(src,dst)
+        self._remove_stale_gzip(dst)
+        self.build_state.add_output(dst)
+
+    def _remove_stale_gzip(self, filename):
+        """
+        the output dir is not wiped between builds, a precompressed variant
+        left by a build with other gzip_static settings would be served
+        instead of the new content
+        """
+        if self.otarget.is_gzipped(filename):
+            return
+        gzip_filename = '%s.gz' % filename
+        if os.path.isfile(gzip_filename) and gzip_filename not in self._get_media_outputs():
+            os.remove(gzip_filename)
+
+    def _get_media_outputs(self):
+        """
+        @return abs filenames of the media outputs, a media file may itself end with .gz
+        """
+        if self.media_outputs is None:
+            self.media_outputs = set( [ self.inr.get_abs_path(m.name) for m in self.media.get_medias() ] )
+        return self.media_outputs
         
     def make_navigation(self, from_item_name):
         return self.navR.make_navigation(from_item_name)
@@ -866,10 +2765,23 @@ class SiteConfig:
         self.blog_posts_per_page = 10
         self.blog_posts_in_feeds = 20
         self.gzip_static = []
+        self.media_fingerprint = False
+        self.image_widths = []
+        self.image_quality = 85
+        self.output_filters = []
+        self.digest = None
+        self.link_validation = "warn"
+        self.artifact_store = None
+        self.header_manifest = None
+        self.header_snippets = []
+        self.sitemap = False
 
     def load(self):
         parser = ConfigParser()
         parser.read(self.config_file)
+        f = open(self.config_file, "rb")
+        self.digest = hashlib.sha1(f.read()).hexdigest()
+        f.close()
         self.baseurl = parser.get("weavy", "baseurl")
         self.site_title = parser.get("weavy", "site_title")
         self.site_description = parser.get("weavy", "site_description")
@@ -877,6 +2789,29 @@ class SiteConfig:
         self.blog_posts_per_page = parser.getint("weavy", "blog_posts_per_page")
         self.blog_posts_in_feeds = parser.getint("weavy", "blog_posts_in_feeds")
         self.gzip_static = parser.get("weavy", "gzip_static").split(",")
+        if parser.has_option("weavy", "media_fingerprint"):
+            self.media_fingerprint = parser.getboolean("weavy", "media_fingerprint")
+        if parser.has_option("weavy", "image_widths"):
+            widths = parser.get("weavy", "image_widths").split(",")
+            self.image_widths = [ int(w) for w in widths if w.strip() != "" ]
+        if parser.has_option("weavy", "image_quality"):
+            self.image_quality = parser.getint("weavy", "image_quality")
+        if parser.has_option("weavy", "link_validation"):
+            self.link_validation = parser.get("weavy", "link_validation")
+            if self.link_validation not in ["off", "warn", "strict"]:
+                raise WeavyError('link_validation must be one of off, warn, strict but is: %s' % self.link_validation)
+        if parser.has_option("weavy", "artifact_store"):
+            self.artifact_store = parser.get("weavy", "artifact_store").strip() or None
+        if parser.has_option("weavy", "sitemap"):
+            self.sitemap = parser.getboolean("weavy", "sitemap")
+        if parser.has_option("weavy", "header_manifest"):
+            self.header_manifest = parser.get("weavy", "header_manifest").strip() or None
+        if parser.has_option("weavy", "header_snippets"):
+            snippets = parser.get("weavy", "header_snippets").split(",")
+            self.header_snippets = [ snippet.strip() for snippet in snippets if snippet.strip() != "" ]
+        if parser.has_option("weavy", "output_filters"):
+            filters = parser.get("weavy", "output_filters").split(",")
+            self.output_filters = [ f.strip() for f in filters if f.strip() != "" ]
 
     def get_baseurl(self):
         return self.baseurl
@@ -899,37 +2834,137 @@ class SiteConfig:
     def get_gzip_static(self):
         return self.gzip_static
 
+    def get_media_fingerprint(self):
+        return self.media_fingerprint
+
+    def get_image_widths(self):
+        return self.image_widths
+
+    def get_image_quality(self):
+        return self.image_quality
+
+    def get_output_filters(self):
+        return self.output_filters
+
+    def get_digest(self):
+        return self.digest
+
+    def get_link_validation(self):
+        return self.link_validation
+
+    def get_artifact_store(self):
+        return self.artifact_store
+
+    def get_sitemap(self):
+        return self.sitemap
+
+    def get_header_manifest(self):
+        return self.header_manifest
+
+    def get_header_snippets(self):
+        return self.header_snippets
+
+def validate_links(data_sources, micro_template_engine, site_renderer):
+    """
+    @return list of (filename, line number, item name string) for every dangling reference
+        in blog posts, pages and templates
+    """
+    validator = LinkValidator()
+    for site_items in [data_sources.blog.get_posts(), data_sources.pages.get_pages(), data_sources.media.get_medias()]:
+        validator.add_item_names( [item.name for item in site_items] )
+    validator.add_item_names( site_renderer.get_generated_item_names() )
+
+    for site_items in [data_sources.blog.get_posts(), data_sources.pages.get_pages()]:
+        for item in site_items:
+            validator.check(item.path, item.references)
+    for filename, references in sorted(micro_template_engine.get_template_references().items()):
+        validator.check(filename, references)
+    return validator.get_dangling()
+
 def erase_dir_contents(pathname):
     shutil.rmtree(pathname)
     os.mkdir(pathname)
 
-def main():
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='render the weavy site in the current directory into out/')
+    parser.add_argument('--cache-import', metavar='TARBALL',
+        help='merge an exported artifact store into the configured one before building')
+    parser.add_argument('--cache-export', metavar='TARBALL',
+        help='export the configured artifact store after building')
+    parser.add_argument('--cache-gc', metavar='DAYS', type=int,
+        help='remove artifacts that were not used for DAYS days after building')
+    parser.add_argument('--only', metavar='PATTERN', action='append',
+        help='render only items whose names match the glob PATTERN, e.g. blog:2015/02/* (can be repeated)')
+    parser.add_argument('--with-dependents', action='store_true',
+        help='with --only, also render blog pages, feed and archives that show the selected items')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
     floc = FolderLocator()
   
     log('loading site.conf...')
     config = SiteConfig(os.path.join(floc.get_in_dir(), "site.conf"))
     config.load()
 
+    artifact_store = None
+    if config.get_artifact_store():
+        artifact_store = ArtifactStore(os.path.join(floc.get_in_dir(), config.get_artifact_store()))
+    elif args.cache_import or args.cache_export or args.cache_gc is not None:
+        raise WeavyError('the --cache-* options need an artifact_store in site.conf')
+    if args.cache_import:
+        log('importing artifacts from %s...' % args.cache_import)
+        log('%d artifacts imported' % artifact_store.import_archive(args.cache_import))
+
     out_dir = floc.get_out_dir()
-    log('cleaning output dir %s...' % out_dir)
-    erase_dir_contents(out_dir)
-    
-    log('loading blog data...')
-    blog_dir = floc.get_blog_dir()
-    blog_data = BlogDataSource(blog_dir)
-    blog_data.load_data()
-    
-    log('loading pages data...')
-    pages_dir = floc.get_pages_dir()
-    pages_data = PagesDataSource(pages_dir)
-    pages_data.load_data()
+    build_state = BuildState(out_dir, os.path.join(floc.get_cache_dir(), "build_state.json"))
+    if not build_state.load() and not args.only:
+        log('cleaning output dir %s...' % out_dir)
+        erase_dir_contents(out_dir)
+
+    selector = None
+    if args.only:
+        selector = ItemSelector(args.only)
     
-    log('loading media data...')
-    media_dir = floc.get_media_dir()
-    media_data = MediaDataSource(media_dir)
-    media_data.load_data()
+    log('loading blog, pages and media data...')
+    blog_data = BlogDataSource(floc.get_blog_dir())
+    blog_data.set_artifact_store(artifact_store)
+    pages_data = PagesDataSource(floc.get_pages_dir())
+    pages_data.set_artifact_store(artifact_store)
+    media_data = MediaDataSource(floc.get_media_dir())
+    # files are read in a thread pool, markdown is converted afterwards
+    # in a process pool (see make_process_executor())
+    with concurrent.futures.ThreadPoolExecutor() as io_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=3) as source_executor:
+        loads = [ source_executor.submit(blog_data.read_data, selector, io_executor),
+                  source_executor.submit(pages_data.read_data, selector, io_executor),
+                  source_executor.submit(media_data.load_data, io_executor) ]
+        for load in loads:
+            load.result()
+    unfiltered = blog_data.take_unfiltered() + pages_data.take_unfiltered()
+    markdown_executor = make_process_executor()
+    try:
+        filter_contents(unfiltered, artifact_store, markdown_executor)
+    finally:
+        if markdown_executor:
+            markdown_executor.shutdown()
 
     inr = ItemNameResolver(out_dir, config.get_baseurl())
+    digests = FileDigestCache(os.path.join(floc.get_cache_dir(), "file_digests.json"))
+    digests.load()
+    if config.get_image_widths():
+        log('processing images...')
+        derivatives_dir = os.path.join(floc.get_cache_dir(), "derivatives")
+        imgproc = ImageDerivativeProcessor(derivatives_dir, digests, config.get_image_widths(), config.get_image_quality())
+        imgproc.process(media_data)
+        inr.set_image_derivatives(imgproc.get_derivatives())
+
+    if config.get_media_fingerprint():
+        log('fingerprinting media...')
+        fingerprinter = MediaFingerprinter(digests, make_output_filters(config.get_output_filters()))
+        fingerprinter.fingerprint(media_data.get_medias())
+        inr.set_media_fingerprinter(fingerprinter)
+
     ds = DataSources(blog_data, pages_data, media_data)
 
     log('loading templates...')
@@ -937,9 +2972,42 @@ def main():
     mte = MicroTemplateEngine(template_dir, inr)
     mte.load_all_templates() 
     
-    log('rendering site...')
     siteR = SiteRenderer(inr, ds, mte, config)
-    siteR.render()
+    siteR.set_build_state(build_state)
+    siteR.set_artifact_store(artifact_store)
+
+    if config.get_link_validation() != "off":
+        log('validating links...')
+        dangling = validate_links(ds, mte, siteR)
+        for filename, lineno, item_name_str in dangling:
+            log('%s:%d: dangling reference ${%s}' % (filename, lineno, item_name_str))
+        if len(dangling) > 0 and config.get_link_validation() == "strict":
+            log('%d dangling references found, not rendering the site' % len(dangling))
+            return 1
+
+    log('rendering site...')
+    if selector:
+        siteR.render_selected(selector, args.with_dependents)
+    else:
+        siteR.render()
+    build_state.save()
+
+    if config.get_header_manifest():
+        manifest_dir = os.path.join(floc.get_in_dir(), config.get_header_manifest())
+        log('writing header manifest to %s...' % manifest_dir)
+        manifest_writer = HeaderManifestWriter(out_dir, config.get_baseurl(), digests)
+        num_entries = manifest_writer.write(manifest_dir, siteR.get_output_items(), build_state.get_outputs(), config.get_header_snippets())
+        log('%d files in header manifest' % num_entries)
+    digests.save()
+
+    if artifact_store:
+        log('artifact store: %d hits, %d misses' % (artifact_store.hits, artifact_store.misses))
+        if args.cache_gc is not None:
+            num_removed, bytes_freed = artifact_store.collect_garbage(args.cache_gc)
+            log('removed %d unused artifacts (%d bytes)' % (num_removed, bytes_freed))
+        if args.cache_export:
+            log('exporting artifacts to %s...' % args.cache_export)
+            artifact_store.export_archive(args.cache_export)
 
     return 0
 